@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for Pocketbook Highlights Sync.
+Generates synthetic Pocketbook books.db and Calibre metadata.db files,
+times each stage of the sync pipeline separately and measures the memory
+held by an extracted library.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import sync_highlights
+
+# Preset sizes: (highlights, device books, Calibre books)
+SCALES = {
+    'small': (1000, 100, 1000),
+    'medium': (20000, 1000, 10000),
+    'large': (200000, 5000, 50000),
+}
+
+# Items added since the last sync in the incremental extraction stages,
+# roughly one reading session
+INCREMENTAL_ITEMS = 20
+
+# Cold-start budget for a new Python process that imports the sync, or
+# runs it with --batch and exits because no device is mounted
+COLD_START_TARGET_SECONDS = 0.1
+
+WORDS = (
+    "time light river shadow stone garden memory winter letter house night "
+    "city fire water silence mountain dream voice road heart history world "
+    "empire island mirror journey storm forest ocean glass paper machine "
+    "kingdom window north summer autumn spring moon star field song war peace"
+).split()
+
+FIRST_NAMES = "James Toni Ursula Jorge Virginia Fyodor Octavia Italo Zadie Haruki Chinua Clarice".split()
+LAST_NAMES = "Baldwin Morrison Le Guin Borges Woolf Dostoevsky Butler Calvino Smith Murakami Achebe Lispector".split()
+
+
+def random_title(rng):
+    """Make up a book title, sometimes with a subtitle."""
+    title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))).title()
+    if rng.random() < 0.3:
+        title += ': ' + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 4))).title()
+    return title
+
+
+def random_author(rng):
+    """Make up an author name."""
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+
+
+def random_sentence(rng):
+    """Make up a highlight-sized run of text."""
+    words = [rng.choice(WORDS) for _ in range(rng.randint(8, 60))]
+    return ' '.join(words).capitalize() + '.'
+
+
+def make_catalog(calibre_books, seed=0):
+    """Make up ``(title, author)`` pairs shared by both generated databases."""
+    rng = random.Random(seed)
+    catalog = []
+    seen = set()
+    while len(catalog) < calibre_books:
+        title = random_title(rng)
+        if title in seen:
+            continue
+        seen.add(title)
+        catalog.append((title, random_author(rng)))
+    return catalog
+
+
+def write_calibre_db(library_path, catalog):
+    """Write a Calibre library with a metadata.db for the catalog."""
+    library_path.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(library_path / 'metadata.db')
+    conn.executescript("""
+        CREATE TABLE books (id INTEGER PRIMARY KEY, title TEXT NOT NULL DEFAULT 'Unknown',
+                            sort TEXT, path TEXT NOT NULL DEFAULT '', timestamp TIMESTAMP,
+                            last_modified TIMESTAMP);
+        CREATE TABLE authors (id INTEGER PRIMARY KEY, name TEXT NOT NULL, sort TEXT, link TEXT);
+        CREATE TABLE books_authors_link (id INTEGER PRIMARY KEY, book INTEGER NOT NULL,
+                                         author INTEGER NOT NULL, UNIQUE(book, author));
+        CREATE TABLE data (id INTEGER PRIMARY KEY, book INTEGER NOT NULL, format TEXT NOT NULL,
+                           uncompressed_size INTEGER NOT NULL, name TEXT NOT NULL,
+                           UNIQUE(book, format));
+        CREATE INDEX books_authors_link_aidx ON books_authors_link (author);
+        CREATE INDEX books_authors_link_bidx ON books_authors_link (book);
+        CREATE INDEX data_idx ON data (book);
+    """)
+
+    author_ids = {}
+    for book_id, (title, author) in enumerate(catalog, 1):
+        author_id = author_ids.setdefault(author, len(author_ids) + 1)
+        path = f"{author}/{title} ({book_id})"
+        conn.execute("INSERT INTO books (id, title, sort, path) VALUES (?, ?, ?, ?)", (book_id, title, title, path))
+        conn.execute("INSERT OR IGNORE INTO authors (id, name, sort) VALUES (?, ?, ?)", (author_id, author, author))
+        conn.execute("INSERT INTO books_authors_link (book, author) VALUES (?, ?)", (book_id, author_id))
+        conn.execute("INSERT INTO data (book, format, uncompressed_size, name) VALUES (?, 'EPUB', 0, ?)",
+                     (book_id, f"{title} - {author}"))
+
+    conn.commit()
+    conn.close()
+
+
+def device_title(title, rng):
+    """Vary a Calibre title the way Pocketbook's doc.book-title tends to differ."""
+    roll = rng.random()
+    if roll < 0.6:
+        return title
+    if roll < 0.75:
+        return title.split(':')[0]
+    if roll < 0.9:
+        return title.replace('a', 'á', 1).lower()
+    return title + ' (Illustrated Edition)'
+
+
+def quotation_json(rng, page, spine, text):
+    """Build a bm.quotation value the way the device stores it."""
+    step = rng.randint(1, 200) * 2
+    offset = rng.randint(0, 4000)
+    begin = f"pbr:/word?page={page}&offs={offset}#epubcfi(/6/{spine}!/4/{step}/1:{rng.randint(0, 400)})"
+    end = f"pbr:/word?page={page}&offs={offset + len(text)}#epubcfi(/6/{spine}!/4/{step}/1:{rng.randint(400, 800)})"
+    return json.dumps({'begin': begin, 'end': end, 'text': text}, ensure_ascii=False, separators=(',', ':'))
+
+
+def write_books_db(db_path, catalog, highlights, books, seed=0):
+    """Write a Pocketbook books.db with the TagNames/Items/Tags schema.
+
+    ``highlights`` bookmark items are spread over ``books`` books drawn from
+    the catalog. About one in twenty is a plain bookmark and one in five
+    carries a note.
+    """
+    rng = random.Random(seed)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE TagNames (OID INTEGER PRIMARY KEY, TagName TEXT);
+        CREATE TABLE Items (OID INTEGER PRIMARY KEY, ParentID INTEGER, TypeID INTEGER,
+                            State INTEGER, TimeAlt INTEGER, HashUUID TEXT);
+        CREATE TABLE Tags (OID INTEGER PRIMARY KEY, ItemID INTEGER, TagID INTEGER,
+                           Val TEXT, TimeEdt INTEGER);
+    """)
+
+    tag_names = ['doc.book-title', 'ro.authors', 'doc.authors', 'bm.quotation', 'bm.note', 'bm.color']
+    tag_ids = {name: oid for oid, name in enumerate(tag_names, 1)}
+    conn.executemany("INSERT INTO TagNames (OID, TagName) VALUES (?, ?)", [(oid, name) for name, oid in tag_ids.items()])
+
+    chosen = rng.sample(catalog, min(books, len(catalog)))
+    items = []
+    tags = []
+    oid = 0
+    timestamp = 1600000000
+
+    book_ids = []
+    for title, author in chosen:
+        oid += 1
+        book_ids.append(oid)
+        items.append((oid, None, 1, 0, timestamp, None))
+        tags.append((oid, tag_ids['doc.book-title'], device_title(title, rng), timestamp))
+        tags.append((oid, tag_ids['ro.authors'], author, timestamp))
+
+    for _ in range(highlights):
+        oid += 1
+        timestamp += rng.randint(1, 600)
+        parent = rng.choice(book_ids)
+        items.append((oid, parent, 4, 0, timestamp, None))
+        page = rng.randint(1, 600)
+        spine = rng.randint(1, 40) * 2
+        text = 'Bookmark' if rng.random() < 0.05 else random_sentence(rng)
+        tags.append((oid, tag_ids['bm.quotation'], quotation_json(rng, page, spine, text), timestamp))
+        tags.append((oid, tag_ids['bm.color'], 'yellow', timestamp))
+        if rng.random() < 0.2:
+            tags.append((oid, tag_ids['bm.note'], random_sentence(rng), timestamp))
+
+    conn.executemany("INSERT INTO Items VALUES (?, ?, ?, ?, ?, ?)", items)
+    conn.executemany("INSERT INTO Tags (ItemID, TagID, Val, TimeEdt) VALUES (?, ?, ?, ?)", tags)
+    conn.commit()
+    conn.close()
+
+
+def generate_library(workdir, highlights, books, calibre_books, seed=0):
+    """Generate books.db and a Calibre library under ``workdir``."""
+    catalog = make_catalog(max(calibre_books, books), seed)
+    db_path = workdir / 'device' / 'system' / 'config' / 'books.db'
+    calibre_path = workdir / 'Calibre Library'
+    write_books_db(db_path, catalog, highlights, books, seed)
+    write_calibre_db(calibre_path, catalog[:calibre_books])
+    return db_path, calibre_path
+
+
+def time_stage(func, repeat):
+    """Run ``func`` ``repeat`` times and return its last result and timings."""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return result, {
+        'min_seconds': round(min(timings), 6),
+        'median_seconds': round(statistics.median(timings), 6),
+        'runs': len(timings)
+    }
+
+
+def measure_memory(db_path):
+    """Return the memory held by a fully extracted library, via tracemalloc."""
+    tracemalloc.start()
+    try:
+        books = sync_highlights.extract_highlights(db_path)
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    highlight_count = sum(len(book.highlights) for book in books)
+    return {
+        'retained_bytes': retained,
+        'peak_bytes': peak,
+        'bytes_per_highlight': round(retained / max(highlight_count, 1))
+    }
+
+
+def measure_cold_start(workdir, repeat):
+    """Time fresh interpreters importing the sync and failing fast in --batch mode."""
+    env = dict(os.environ, HOME=str(workdir))
+    commands = {
+        'import': [sys.executable, '-c', 'import sync_highlights'],
+        'batch_no_device': [sys.executable, '-m', 'sync_highlights', '--batch',
+                            '--device', str(Path(workdir) / 'missing')],
+    }
+    results = {}
+    for name, command in commands.items():
+        def run():
+            subprocess.run(command, cwd=Path(__file__).parent, env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _, results[name] = time_stage(run, max(repeat, 5))
+    results['target_seconds'] = COLD_START_TARGET_SECONDS
+    return results
+
+
+def run_benchmark(workdir, db_path, calibre_path, repeat=3, workers=sync_highlights.DEFAULT_WRITE_WORKERS,
+                  templates=None):
+    """Time extraction, Calibre lookup, rendering and writing separately.
+
+    Full and incremental extraction are each timed on the plain database
+    and on a copy with the snapshot indexes from
+    sync_highlights.index_snapshot().
+
+    ``templates`` from sync_highlights.compile_note_templates() replaces the
+    default note layout when rendering.
+    """
+    stages = {}
+
+    books, stages['extract'] = time_stage(lambda: sync_highlights.extract_highlights(db_path), repeat)
+    highlight_count = sum(len(book.highlights) for book in books)
+
+    # The same extraction on a copy with the --index-snapshot indexes, then
+    # incremental syncs that pick up the newest INCREMENTAL_ITEMS on both
+    indexed_path = Path(workdir) / 'books-indexed.db'
+    shutil.copyfile(db_path, indexed_path)
+    _, stages['index_build'] = time_stage(lambda: sync_highlights.index_snapshot(indexed_path), 1)
+    _, stages['extract_indexed'] = time_stage(
+        lambda: sync_highlights.extract_highlights(indexed_path), repeat
+    )
+
+    watermark = sync_highlights.get_highlight_watermark(db_path)
+    since = {'max_oid': watermark['max_oid'] - INCREMENTAL_ITEMS, 'max_time': watermark['max_time']}
+    _, stages['incremental'] = time_stage(lambda: list(sync_highlights.iter_books(db_path, since=since)), repeat)
+    _, stages['incremental_indexed'] = time_stage(
+        lambda: list(sync_highlights.iter_books(indexed_path, since=since)), repeat
+    )
+
+    # Reading metadata.db and building the match index, as on a sync whose
+    # Calibre cache is missing or stale; then matching from a warm cache
+    # kept in the workdir rather than the user's own
+    _, stages['calibre_index'] = time_stage(lambda: sync_highlights.build_calibre_index(calibre_path), repeat)
+    cache_dir = Path(workdir) / 'cache'
+    sync_highlights.load_calibre_index(calibre_path, cache_dir)
+
+    def lookup():
+        return [
+            calibre_info
+            for _, calibre_info in sync_highlights.match_calibre_books(books, calibre_path, cache_dir)
+        ]
+
+    calibre_infos, stages['calibre_lookup'] = time_stage(lookup, repeat)
+
+    def render():
+        return [
+            sync_highlights.render_obsidian_note(book, calibre_info, calibre_path, sync_date='2026-01-01',
+                                                 synced='2026-01-01 00:00', templates=templates)
+            for book, calibre_info in zip(books, calibre_infos)
+        ]
+
+    contents, stages['render'] = time_stage(render, repeat)
+
+    def write():
+        vault = Path(tempfile.mkdtemp(dir=workdir, prefix='vault-'))
+        paths = [vault / sync_highlights.sanitize_filename(f"{book.title}.md") for book in books]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(sync_highlights.write_file_atomic, paths, contents))
+        return vault
+
+    _, stages['write'] = time_stage(write, repeat)
+
+    for name in ('extract', 'extract_indexed'):
+        stages[name]['highlights_per_second'] = round(highlight_count / max(stages[name]['min_seconds'], 1e-9))
+    stages['render']['highlights_per_second'] = round(highlight_count / max(stages['render']['min_seconds'], 1e-9))
+    stages['write']['bytes'] = sum(len(content.encode('utf-8')) for content in contents)
+
+    return {
+        'books': len(books),
+        'highlights': highlight_count,
+        'calibre_matches': sum(1 for info in calibre_infos if info),
+        'stages': stages,
+        'memory': measure_memory(db_path),
+        'cold_start': measure_cold_start(workdir, repeat)
+    }
+
+
+def git_commit():
+    """Return the current git commit, if any."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    """Print a per-stage timing table."""
+    print(f"\n{results['highlights']} highlights in {results['books']} book(s), "
+          f"{results['calibre_matches']} matched to Calibre")
+    print("-" * 60)
+    print(f"{'Stage':<20}{'min (s)':>12}{'median (s)':>14}{'highlights/s':>14}")
+    for name, stage in results['stages'].items():
+        rate = stage.get('highlights_per_second', '')
+        print(f"{name:<20}{stage['min_seconds']:>12.4f}{stage['median_seconds']:>14.4f}{rate:>14}")
+    memory = results['memory']
+    cold_start = results['cold_start']
+    print(f"\nCold start: import {cold_start['import']['min_seconds'] * 1000:.0f} ms, "
+          f"--batch without device {cold_start['batch_no_device']['min_seconds'] * 1000:.0f} ms "
+          f"(target {cold_start['target_seconds'] * 1000:.0f} ms)")
+    print(f"\nExtracted library: {memory['retained_bytes'] / 1e6:.1f} MB held, "
+          f"{memory['peak_bytes'] / 1e6:.1f} MB peak, {memory['bytes_per_highlight']} bytes per highlight")
+
+
+def parse_args(argv=None):
+    """Parse command-line options."""
+    parser = argparse.ArgumentParser(description="Benchmark the sync pipeline on synthetic data.")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small',
+                        help="preset data size (default: small)")
+    parser.add_argument('--highlights', type=int, help="number of highlights on the device")
+    parser.add_argument('--books', type=int, help="number of books with highlights on the device")
+    parser.add_argument('--calibre-books', type=int, help="number of books in the Calibre library")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per stage (default: 3)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed for the generated data")
+    parser.add_argument('--templates', metavar='DIR',
+                        help="render with the note templates in DIR instead of the default layout")
+    parser.add_argument('--json', metavar='PATH', help="write results as JSON to PATH")
+    parser.add_argument('--keep', metavar='DIR', help="generate data in DIR and keep it")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the benchmark."""
+    args = parse_args(argv)
+    highlights, books, calibre_books = SCALES[args.scale]
+    highlights = args.highlights or highlights
+    books = args.books or books
+    calibre_books = args.calibre_books or calibre_books
+
+    if args.keep:
+        workdir = Path(args.keep).expanduser()
+        workdir.mkdir(parents=True, exist_ok=True)
+    else:
+        workdir = Path(tempfile.mkdtemp(prefix='pocketbook-bench-'))
+
+    try:
+        print(f"Generating {highlights} highlights in {books} book(s), "
+              f"{calibre_books} Calibre book(s) in {workdir}...")
+        db_path, calibre_path = generate_library(workdir, highlights, books, calibre_books, args.seed)
+
+        templates = sync_highlights.load_note_templates(args.templates) if args.templates else None
+        results = run_benchmark(workdir, db_path, calibre_path, repeat=args.repeat, templates=templates)
+        results.update({
+            'commit': git_commit(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'parameters': {
+                'highlights': highlights,
+                'books': books,
+                'calibre_books': calibre_books,
+                'repeat': args.repeat,
+                'seed': args.seed,
+                'templates': args.templates
+            }
+        })
+
+        print_results(results)
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"\nResults written to: {args.json}")
+
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n\nBenchmark cancelled by user.")
+        sys.exit(1)
@@ -1,73 +1,312 @@
 #!/usr/bin/env python3
 """
 Quick script to inspect the Pocketbook database schema.
-Run this to see what tables and columns exist in your books.db
+Run this to see what tables, columns and indexes exist in your books.db,
+how the sync's extraction queries are planned, and which indexes are
+missing.
+
+Row counts are estimated from sqlite_stat1 or the largest rowid, so a
+database on the device is not scanned table by table. Use --exact for
+real counts.
 """
 
+import argparse
+import json
 import sqlite3
 import sys
 from pathlib import Path
 
-def inspect_database(db_path):
-    """Inspect database structure and show sample data."""
-    print(f"Inspecting: {db_path}\n")
+import sync_highlights
+
+# Indexes that turn the extraction query's scans into index lookups:
+# (table, columns, what the sync uses them for). An existing index whose
+# first column matches counts as present.
+INDEX_ADVICE = [
+    ('Tags', ('TagID', 'ItemID', 'Val'), "reads quotation, title, author and note tags without scanning every tag"),
+    ('Items', ('TypeID', 'ParentID', 'TimeAlt'), "finds highlight items (TypeID 4) without scanning every item"),
+]
+
+
+def quote_identifier(name):
+    """Quote a table or index name for use in SQL."""
+    return '"' + name.replace('"', '""') + '"'
 
+
+def open_readonly(db_path):
+    """Open books.db read-only so inspecting never writes to the device."""
+    return sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+
+
+def read_stat1(conn):
+    """Return row counts recorded by ANALYZE in sqlite_stat1, per table."""
     try:
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-
-        # Get all tables
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")
-        tables = [row[0] for row in cursor.fetchall()]
-
-        print(f"Found {len(tables)} tables:")
-        print("=" * 60)
-
-        for table in tables:
-            print(f"\n📊 Table: {table}")
-            print("-" * 60)
-
-            # Get column info
-            cursor.execute(f"PRAGMA table_info({table})")
-            columns = cursor.fetchall()
-
-            print("Columns:")
-            for col in columns:
-                print(f"  - {col['name']:20} {col['type']:15} {'PRIMARY KEY' if col['pk'] else ''}")
-
-            # Get row count
-            cursor.execute(f"SELECT COUNT(*) as count FROM {table}")
-            count = cursor.fetchone()['count']
-            print(f"\nRow count: {count}")
-
-            # Show sample data if table has rows
-            if count > 0:
-                cursor.execute(f"SELECT * FROM {table} LIMIT 3")
-                rows = cursor.fetchall()
-                if rows:
-                    print("\nSample data (first 3 rows):")
-                    for i, row in enumerate(rows, 1):
-                        print(f"\n  Row {i}:")
-                        for key in row.keys():
-                            value = row[key]
-                            if value is not None:
-                                # Truncate long values
-                                if isinstance(value, str) and len(value) > 50:
-                                    value = value[:47] + "..."
-                                print(f"    {key}: {value}")
+        rows = conn.execute("SELECT tbl, stat FROM sqlite_stat1").fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    counts = {}
+    for table, stat in rows:
+        try:
+            counts.setdefault(table, int(str(stat).split()[0]))
+        except (ValueError, IndexError):
+            continue
+    return counts
+
+
+def count_rows(conn, table, sql, stat1, exact=False):
+    """Return ``(rows, source)`` for a table, estimated unless ``exact``.
+
+    The largest rowid is read from the end of the table's b-tree, so it
+    costs a few page reads instead of a full scan. It is an upper bound
+    when rows have been deleted.
+    """
+    if exact:
+        return conn.execute(f"SELECT COUNT(*) FROM {quote_identifier(table)}").fetchone()[0], 'count'
+    if table in stat1:
+        return stat1[table], 'sqlite_stat1'
+    if sql and sql.upper().startswith('CREATE VIRTUAL TABLE'):
+        return None, None
+    try:
+        max_rowid = conn.execute(f"SELECT MAX(rowid) FROM {quote_identifier(table)}").fetchone()[0]
+    except sqlite3.OperationalError:
+        return None, None
+    return max_rowid or 0, 'max_rowid'
+
+
+def table_indexes(conn, table):
+    """List a table's indexes with their columns in order."""
+    indexes = []
+    for index in conn.execute(f"PRAGMA index_list({quote_identifier(table)})").fetchall():
+        name, unique = index[1], bool(index[2])
+        columns = [
+            column[2] for column in conn.execute(f"PRAGMA index_info({quote_identifier(name)})").fetchall()
+        ]
+        indexes.append({'name': name, 'columns': columns, 'unique': unique})
+    return indexes
+
+
+def sample_rows(conn, table, limit):
+    """Return up to ``limit`` rows as dicts, with long values truncated."""
+    cursor = conn.execute(f"SELECT * FROM {quote_identifier(table)} LIMIT ?", (limit,))
+    names = [description[0] for description in cursor.description]
+    samples = []
+    for row in cursor.fetchall():
+        sample = {}
+        for key, value in zip(names, row):
+            if isinstance(value, bytes):
+                value = f"<{len(value)} bytes>"
+            elif isinstance(value, str) and len(value) > 50:
+                value = value[:47] + "..."
+            sample[key] = value
+        samples.append(sample)
+    return samples
+
+
+def extraction_queries(conn):
+    """Return ``(name, sql, params)`` for each query a sync runs on books.db."""
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    try:
+        tag_ids = sync_highlights.get_tag_ids(cursor, sync_highlights.HIGHLIGHT_TAG_NAMES)
+    except sqlite3.Error:
+        tag_ids = {}
+    use_json1 = sync_highlights.has_json1(conn)
+    since = {'max_oid': 0, 'max_time': 0}
+
+    return [
+        ('tag ids', sync_highlights.tag_ids_query(len(sync_highlights.HIGHLIGHT_TAG_NAMES)),
+         tuple(sync_highlights.HIGHLIGHT_TAG_NAMES)),
+        ('watermark', sync_highlights.WATERMARK_QUERY, ()),
+        ('highlight counts', sync_highlights.HIGHLIGHT_COUNTS_QUERY, ()),
+        ('highlights', sync_highlights.build_highlights_query(use_json1),
+         sync_highlights.highlights_query_params(tag_ids)),
+        ('highlights (incremental)', sync_highlights.build_highlights_query(use_json1, incremental=True),
+         sync_highlights.highlights_query_params(tag_ids, since)),
+    ]
+
+
+def explain_queries(conn):
+    """Run EXPLAIN QUERY PLAN on the extraction queries.
+
+    Full scans of the tables in INDEX_ADVICE are flagged; those grow with
+    the library, while scanning TagNames is cheap.
+    """
+    table_names = {table for table, _, _ in INDEX_ADVICE}
+    plans = []
+    for name, sql, params in extraction_queries(conn):
+        plan = {'name': name, 'sql': ' '.join(sql.split()), 'steps': [], 'full_scans': []}
+        try:
+            rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        except sqlite3.Error as e:
+            plan['error'] = str(e)
+            plans.append(plan)
+            continue
+
+        for step_id, parent, _, detail in rows:
+            plan['steps'].append({'id': step_id, 'parent': parent, 'detail': detail})
+            words = detail.split()
+            if (len(words) >= 2 and words[0] == 'SCAN' and words[1] in table_names
+                    and 'INDEX' not in detail and words[1] not in plan['full_scans']):
+                plan['full_scans'].append(words[1])
+        plans.append(plan)
+    return plans
+
+
+def advise_indexes(tables):
+    """Return the INDEX_ADVICE entries not covered by an existing index."""
+    by_name = {table['name']: table for table in tables}
+    advice = []
+    for table_name, columns, reason in INDEX_ADVICE:
+        table = by_name.get(table_name)
+        if table is None:
+            continue
+        table_columns = {column['name'].lower() for column in table['columns']}
+        if not all(column.lower() in table_columns for column in columns):
+            continue
+        if any(index['columns'] and index['columns'][0].lower() == columns[0].lower()
+               for index in table['indexes']):
+            continue
+        index_name = f"idx_{table_name}_{'_'.join(columns)}".lower()
+        advice.append({
+            'table': table_name,
+            'columns': list(columns),
+            'reason': reason,
+            'sql': f"CREATE INDEX {index_name} ON {table_name}({', '.join(columns)});"
+        })
+    return advice
+
+
+def inspect_database(db_path, exact=False, samples=0):
+    """Collect the schema, row counts, query plans and index advice for books.db."""
+    conn = open_readonly(db_path)
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        stat1 = read_stat1(conn)
+
+        tables = []
+        for name, sql in conn.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'table' ORDER BY name"
+        ).fetchall():
+            rows, rows_source = count_rows(conn, name, sql, stat1, exact)
+            table = {
+                'name': name,
+                'columns': [
+                    {'name': column[1], 'type': column[2], 'notnull': bool(column[3]), 'pk': bool(column[5])}
+                    for column in conn.execute(f"PRAGMA table_info({quote_identifier(name)})").fetchall()
+                ],
+                'indexes': table_indexes(conn, name),
+                'rows': rows,
+                'rows_source': rows_source
+            }
+            if samples and rows != 0:
+                table['samples'] = sample_rows(conn, name, samples)
+            tables.append(table)
 
+        return {
+            'path': str(db_path),
+            'sqlite_version': sqlite3.sqlite_version,
+            'page_size': page_size,
+            'page_count': page_count,
+            'size_bytes': page_size * page_count,
+            'analyzed': bool(stat1),
+            'tables': tables,
+            'query_plans': explain_queries(conn),
+            'index_advice': advise_indexes(tables)
+        }
+    finally:
         conn.close()
-        print("\n" + "=" * 60)
-        print("Inspection complete!")
 
-    except sqlite3.Error as e:
-        print(f"Database error: {e}")
-        sys.exit(1)
 
-if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        db_path = Path(sys.argv[1])
+def print_report(report):
+    """Print an inspection report as text."""
+    print(f"Inspecting: {report['path']}")
+    print(f"{report['page_count']} pages of {report['page_size']} bytes "
+          f"({report['size_bytes'] / 1024 / 1024:.1f} MB), SQLite {report['sqlite_version']}\n")
+
+    print(f"Found {len(report['tables'])} tables:")
+    print("=" * 60)
+
+    for table in report['tables']:
+        print(f"\n📊 Table: {table['name']}")
+        print("-" * 60)
+
+        print("Columns:")
+        for column in table['columns']:
+            print(f"  - {column['name']:20} {column['type']:15} {'PRIMARY KEY' if column['pk'] else ''}")
+
+        if table['indexes']:
+            print("Indexes:")
+            for index in table['indexes']:
+                unique = ' (unique)' if index['unique'] else ''
+                print(f"  - {index['name']}: {', '.join(index['columns'])}{unique}")
+
+        if table['rows_source'] == 'count':
+            print(f"\nRow count: {table['rows']}")
+        elif table['rows_source'] == 'sqlite_stat1':
+            print(f"\nRow count: ~{table['rows']} (sqlite_stat1)")
+        elif table['rows_source'] == 'max_rowid':
+            print(f"\nRow count: at most {table['rows']} (largest rowid; use --exact to count)")
+        else:
+            print("\nRow count: unknown (use --exact to count)")
+
+        if table.get('samples'):
+            print(f"\nSample data (first {len(table['samples'])} rows):")
+            for i, row in enumerate(table['samples'], 1):
+                print(f"\n  Row {i}:")
+                for key, value in row.items():
+                    if value is not None:
+                        print(f"    {key}: {value}")
+
+    print("\n" + "=" * 60)
+    print("Query plans for the sync's extraction queries:")
+    for plan in report['query_plans']:
+        print(f"\n🔎 {plan['name']}")
+        if 'error' in plan:
+            print(f"  Could not plan query: {plan['error']}")
+            continue
+        depth = {0: 0}
+        for step in plan['steps']:
+            depth[step['id']] = depth.get(step['parent'], 0) + 1
+            print(f"  {'  ' * (depth[step['id']] - 1)}{step['detail']}")
+        for table in plan['full_scans']:
+            print(f"  ⚠️  Full scan of {table}")
+
+    print("\n" + "=" * 60)
+    if report['index_advice']:
+        print("Missing indexes:")
+        for advice in report['index_advice']:
+            print(f"\n  ⚠️  {advice['table']}({', '.join(advice['columns'])}) - {advice['reason']}")
+            print(f"     {advice['sql']}")
+        print("\nCreate these on a copy of books.db, not on the device; "
+              "sync_highlights.py --index-snapshot builds them on its local copy.")
+    else:
+        print("No missing indexes found.")
+
+    print("\n" + "=" * 60)
+    print("Inspection complete!")
+
+
+def parse_args(argv=None):
+    """Parse command-line options."""
+    parser = argparse.ArgumentParser(description="Inspect a Pocketbook books.db database.")
+    parser.add_argument('db_path', nargs='?', help="path to books.db (prompted for if omitted)")
+    parser.add_argument('--exact', action='store_true',
+                        help="count rows with COUNT(*) instead of estimating (scans every table)")
+    parser.add_argument('--samples', type=int, default=0, metavar='N',
+                        help="show the first N rows of each table")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args(argv)
+    if args.json and not args.db_path:
+        parser.error("a database path is required with --json")
+    return args
+
+
+def main(argv=None):
+    """Inspect a database and print the report."""
+    args = parse_args(argv)
+
+    if args.db_path:
+        db_path = Path(args.db_path)
     else:
         # Prompt for path
         print("Enter the path to books.db:")
@@ -79,4 +318,17 @@ if __name__ == '__main__':
         print(f"Error: File not found at {db_path}")
         sys.exit(1)
 
-    inspect_database(db_path)
+    try:
+        report = inspect_database(db_path, exact=args.exact, samples=args.samples)
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -168,6 +168,28 @@ def main():
     app_name = app_name_map.get(app_choice, 'Obsidian')
     config['notes_app'] = app_name
 
+    # Notion pages can be created through its API instead of from Markdown files
+    notion_api = False
+    if app_name == 'Notion':
+        print("\nHighlights can be sent straight to Notion. This needs an internal")
+        print("integration token (from https://www.notion.so/my-integrations) and a")
+        print("page shared with that integration; one page per book is created under it.")
+        print("(Press Enter to skip and write Markdown files for importing instead)")
+
+        token = get_input_with_default("\nNotion integration token (optional)", config.get('notion_token'))
+        if token:
+            parent = get_input_with_default("Notion parent page URL or ID", config.get('notion_parent_page'))
+            if parent:
+                config['notion_token'] = token
+                config['notion_parent_page'] = parent
+                notion_api = True
+                print("✓ Notion configured")
+            else:
+                print("No parent page given. Writing Markdown files instead.")
+        if not notion_api:
+            config.pop('notion_token', None)
+            config.pop('notion_parent_page', None)
+
     detected_vault = detect_obsidian_vault() if app_choice == '1' else None
 
     if detected_vault:
@@ -180,7 +202,7 @@ def main():
         else:
             detected_vault = None
 
-    if not detected_vault:
+    if not detected_vault and not notion_api:
         print(f"\nEnter the path to your {app_name} vault/directory.")
         print("This is where your highlight files will be saved.")
 
@@ -207,12 +229,13 @@ def main():
                     break
 
     # Configure highlights folder name
-    print("\nWhat should the highlights folder be called?")
-    folder_name = get_input_with_default(
-        "Folder name",
-        config.get('highlights_folder', 'Book Highlights')
-    )
-    config['highlights_folder'] = folder_name
+    if not notion_api:
+        print("\nWhat should the highlights folder be called?")
+        folder_name = get_input_with_default(
+            "Folder name",
+            config.get('highlights_folder', 'Book Highlights')
+        )
+        config['highlights_folder'] = folder_name
 
     # Step 3: Calibre (optional)
     print_step(3, "Configure Calibre Library (Optional)")
@@ -261,8 +284,11 @@ def main():
     print("Your configuration:")
     print(f"  • Pocketbook: {config.get('pocketbook_path', 'Not configured')}")
     print(f"  • Note-taking app: {config.get('notes_app', 'Obsidian')}")
-    print(f"  • Vault path: {config.get('notes_vault_path', 'Not configured')}")
-    print(f"  • Highlights folder: {config.get('highlights_folder', 'Book Highlights')}")
+    if config.get('notion_token'):
+        print(f"  • Notion parent page: {config['notion_parent_page']}")
+    else:
+        print(f"  • Vault path: {config.get('notes_vault_path', 'Not configured')}")
+        print(f"  • Highlights folder: {config.get('highlights_folder', 'Book Highlights')}")
     print(f"  • Calibre library: {config.get('calibre_library_path', 'Not configured')}")
 
     print(f"\nConfiguration will be saved to: {CONFIG_FILE}")
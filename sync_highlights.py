@@ -6,13 +6,231 @@ Extracts highlights from Pocketbook Touch Lux 3 and formats them for Obsidian.
 
 import sqlite3
 import os
+import re
+import string
 import sys
+import threading
+import time
+import unicodedata
+from operator import attrgetter
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
+from typing import NamedTuple, Optional, Union
 from datetime import datetime
 import json
-from urllib.parse import quote
+import hashlib
+import heapq
+import itertools
+import argparse
 
 CONFIG_FILE = Path.home() / '.pocketbook_sync_config.json'
+STATE_FILE = CONFIG_FILE.with_name('.pocketbook_sync_state.json')
+SNAPSHOT_DIR = CONFIG_FILE.with_name('.pocketbook_sync_cache')
+STORE_FILE = CONFIG_FILE.with_name('.pocketbook_sync_highlights.db')
+NOTION_MAP_FILE = CONFIG_FILE.with_name('.pocketbook_sync_notion.db')
+
+# Exit statuses, so cron and launchd jobs can tell why a sync stopped
+EXIT_OK = 0
+EXIT_ERROR = 1           # unexpected error
+EXIT_USAGE = 2           # invalid command-line options (argparse)
+EXIT_NO_DEVICE = 3       # Pocketbook not mounted or books.db missing
+EXIT_NO_VAULT = 4        # notes vault not configured or missing
+EXIT_CONFIG = 5          # unreadable config file or note templates
+EXIT_WRITE_FAILED = 6    # some notes could not be written
+EXIT_CANCELLED = 130     # interrupted with Ctrl-C
+
+# Environment variables read as defaults for the matching CLI options
+ENV_DEVICE = 'POCKETBOOK_SYNC_DEVICE'
+ENV_VAULT = 'POCKETBOOK_SYNC_VAULT'
+ENV_CALIBRE = 'POCKETBOOK_SYNC_CALIBRE'
+ENV_BATCH = 'POCKETBOOK_SYNC_BATCH'
+# Values that turn on a flag set through the environment, e.g. $POCKETBOOK_SYNC_BATCH
+ENV_TRUE_VALUES = ('1', 'true', 'yes')
+
+# Notion integration token, read instead of "notion_token" in the config file
+ENV_NOTION_TOKEN = 'POCKETBOOK_SYNC_NOTION_TOKEN'
+
+# Where a Pocketbook usually mounts on macOS
+POCKETBOOK_MOUNT_POINTS = [
+    Path('/Volumes/PB626'),
+    Path('/Volumes/PocketBook'),
+    Path('/Volumes/POCKETBOOK'),
+]
+
+# Watch mode: seconds between mount checks, the directory macOS mounts
+# volumes under, and the Linux mount table filesystems a reader can use
+DEFAULT_WATCH_INTERVAL = 2.0
+VOLUMES_DIR = Path('/Volumes')
+MOUNTS_FILE = Path('/proc/self/mounts')
+REMOVABLE_FS_TYPES = {'vfat', 'msdos', 'exfat', 'fuseblk', 'ntfs', 'ntfs3'}
+
+# Notes written concurrently; vault writes are latency-bound, not CPU-bound
+DEFAULT_WRITE_WORKERS = 4
+
+# Books each source's extraction thread may run ahead of the merge
+SOURCE_PREFETCH_BOOKS = 16
+
+# Books with at least this many highlights are split into chapter notes
+# by --shard-chapters
+SHARD_MIN_HIGHLIGHTS = 200
+
+# Books each sync pipeline stage may run ahead of the next one
+PIPELINE_BUFFER_BOOKS = 16
+
+# Notion API: the version we speak, its per-request limits (blocks per
+# append, characters per text object, text objects per block, and request
+# size with headroom below 500 KB), and its average rate limit of three
+# requests a second, shared by a few concurrent requests
+NOTION_API_URL = 'https://api.notion.com/v1'
+NOTION_VERSION = '2022-06-28'
+NOTION_BATCH_BLOCKS = 100
+NOTION_TEXT_LIMIT = 2000
+NOTION_RICH_TEXT_LIMIT = 100
+NOTION_BATCH_BYTES = 400 * 1024
+NOTION_RATE = 3.0
+NOTION_BURST = 3
+NOTION_CONCURRENCY = 3
+NOTION_TIMEOUT = 30
+
+# Retry rate-limited and failed Notion requests this many times, backing
+# off exponentially from NOTION_BACKOFF seconds unless told how long to wait
+NOTION_MAX_RETRIES = 5
+NOTION_BACKOFF = 1.0
+NOTION_BACKOFF_MAX = 30.0
+NOTION_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Memory-map up to 256 MB of the local snapshot for extraction
+SNAPSHOT_MMAP_SIZE = 256 * 1024 * 1024
+
+# Covering indexes for the extraction query, built only on the local
+# snapshot (never on the device): tag values by TagID and item, and
+# highlights by type and book. Tags(ItemID, TagID) is left out on purpose:
+# SQLite then groups book tags by walking it and fetching every Val.
+SNAPSHOT_INDEXES = [
+    ('pbsync_tags_tag_item_val', 'Tags', ('TagID', 'ItemID', 'Val')),
+    ('pbsync_items_type_parent_time', 'Items', ('TypeID', 'ParentID', 'TimeAlt')),
+]
+
+# Fuzzy Calibre matching: minimum score to accept a match, how many books
+# to score in full per lookup, and how many books to scan per title word
+CALIBRE_MATCH_THRESHOLD = 0.6
+CALIBRE_MAX_CANDIDATES = 10
+CALIBRE_MAX_POSTINGS = 500
+# Score factor for a book whose authors share no name with the highlight's;
+# keeps even an identical title below CALIBRE_MATCH_THRESHOLD
+CALIBRE_AUTHOR_MISMATCH = 0.5
+
+# Bump when the cached Calibre entry format changes
+CALIBRE_CACHE_VERSION = 1
+NON_WORD_PATTERN = re.compile(r'[\W_]+')
+NUMBER_PATTERN = re.compile(r'\d+')
+SUBTITLE_PATTERN = re.compile(r'\s*[:(\[]|\s+[-\u2013\u2014]\s+')
+
+# Per-run metrics, printed with --metrics or saved with --metrics-json
+METRICS = {'stages': {}, 'queries': 0, 'rows_read': 0, 'bytes_written': 0, 'highlights': 0}
+_metrics_lock = threading.Lock()
+
+# Tags read from books.db: quotation JSON, book title and authors, and notes
+HIGHLIGHT_TAG_NAMES = ['bm.quotation', 'doc.book-title', 'ro.authors', 'doc.authors', 'bm.note']
+
+# The newest highlight OID and TimeAlt, saved as the incremental watermark
+WATERMARK_QUERY = "SELECT MAX(OID), MAX(TimeAlt) FROM Items WHERE TypeID = 4"
+
+# Highlight items per book. Deleting a highlight leaves the watermark
+# alone, so books whose count changed are re-extracted too; with more than
+# MAX_CHANGED_PARENTS of them a full extraction is simpler
+HIGHLIGHT_COUNTS_QUERY = "SELECT ParentID, COUNT(*) FROM Items WHERE TypeID = 4 GROUP BY ParentID"
+MAX_CHANGED_PARENTS = 500
+
+# Position data in a bm.quotation "begin" value
+PAGE_PATTERN = re.compile(r'page=(\d+)')
+EPUBCFI_PATTERN = re.compile(r'epubcfi\((?:\[(?:\^.|[^\]^])*\]|[^)\[])+\)')
+
+# One token of an EPUB CFI: a step, an indirection into the next document,
+# a character offset, a range separator, or a temporal or spatial offset or
+# an [assertion], which don't affect ordering. Most CFIs are only steps
+# and an offset; without a match for the complex pattern they are parsed
+# by splitting instead of tokenizing.
+EPUBCFI_COMPLEX_PATTERN = re.compile(r'[^\d/!:]')
+EPUBCFI_TOKEN_PATTERN = re.compile(
+    r'/(\d+)|(!)|:(\d+)|(,)|~\d+(?:\.\d+)?|@\d+(?:\.\d+)?:\d+(?:\.\d+)?|\[(?:\^.|[^\]^])*\]'
+)
+
+# Octal escapes (e.g. "\040" for a space) in Linux mount table paths
+MOUNT_ESCAPE_PATTERN = re.compile(r'\\([0-7]{3})')
+
+# The 32 hex digits ending a Notion page ID or URL, dashes removed
+NOTION_ID_PATTERN = re.compile(r'([0-9a-f]{32})$', re.IGNORECASE)
+
+# Volatile lines in a rendered note, reused from the existing file when the
+# rest of the note is unchanged so the bytes stay stable across syncs.
+SYNC_DATE_PATTERN = re.compile(r'^sync_date: (.*)$', re.MULTILINE)
+SYNCED_PATTERN = re.compile(r'^\*\*Synced:\*\* (.*)$', re.MULTILINE)
+
+# The same volatile lines as page properties in a Logseq page
+LOGSEQ_SYNC_DATE_PATTERN = re.compile(r'^sync-date:: (.*)$', re.MULTILINE)
+LOGSEQ_SYNCED_PATTERN = re.compile(r'^synced:: (.*)$', re.MULTILINE)
+
+# Columns of a JSON Lines or CSV export, one row per highlight
+EXPORT_FIELDS = ['book', 'author', 'id', 'text', 'note', 'page', 'epubcfi', 'timestamp', 'type']
+
+# Default note templates (see compile_template() for the syntax). Each
+# template line ends with a newline; the header is followed by a blank line
+# and highlight blocks are separated by a --- line.
+DEFAULT_TEMPLATES = {
+    'frontmatter': """---
+title: {title}
+author: {author}
+type: book-highlights
+sync_date: {sync_date}
+calibre_id: {calibre_id}
+---""",
+    'header': """# {title}
+**Author:** {author}
+**Synced:** {synced}
+{#calibre_url}
+
+**Open in Calibre:**
+- [View in Calibre](<{calibre_url}>)
+- [Open EPUB file](<{epub_url}>)
+{/calibre_url}
+
+---
+
+## Highlights""",
+    'highlight': """{#text}
+> {text}
+
+{/text}
+{#note}
+**Note:** {note}
+
+{/note}
+*{location}*
+[📖 Open in Calibre](<{calibre_link}>)"""
+}
+
+# Values available to the frontmatter and header templates, and additionally
+# to the highlight template
+BOOK_FIELDS = frozenset({'title', 'author', 'sync_date', 'synced', 'calibre_id', 'calibre_url',
+                         'calibre_view_url', 'epub_url'})
+HIGHLIGHT_FIELDS = frozenset({'id', 'text', 'note', 'page', 'added', 'location', 'epubcfi', 'calibre_link'})
+
+# A {#field} or {/field} section line in a template
+TEMPLATE_SECTION_PATTERN = re.compile(r'^\{([#/])(\w+)\}$')
+
+# The characters found in EPUB CFIs, and the percent-encodings that
+# quote(safe='') gives the reserved ones ('%' first, so it is not re-encoded)
+CFI_CHARACTERS_PATTERN = re.compile(r'[A-Za-z0-9_.~\-%()/!:,\[\];=^ ]*')
+CFI_ESCAPES = [(char, f"%{ord(char):02X}") for char in '%()/!:,[];=^ ']
+
+# A highlight block in a merge-mode note, from its start marker (device
+# highlight ID and content hash) to its end marker
+HIGHLIGHT_BLOCK_PATTERN = re.compile(
+    r'^<!-- pocketbook-highlight:(\S+) (\w+) -->$.*?^<!-- /pocketbook-highlight:\1 -->$',
+    re.MULTILINE | re.DOTALL
+)
 
 
 def load_config():
@@ -29,9 +247,114 @@ def save_config(config):
         json.dump(config, f, indent=2)
 
 
-def get_pocketbook_path():
-    """Find or prompt for Pocketbook mount path."""
-    config = load_config()
+def load_state():
+    """Load incremental sync state (watermark and per-book hashes)."""
+    if STATE_FILE.exists():
+        try:
+            with open(STATE_FILE, 'r') as f:
+                return json.load(f)
+        except (ValueError, OSError):
+            print("Warning: Could not read sync state, doing a full sync.")
+    return {}
+
+
+def save_state(state):
+    """Save incremental sync state."""
+    with open(STATE_FILE, 'w') as f:
+        json.dump(state, f, indent=2)
+
+
+def reset_metrics():
+    """Clear the per-run metrics collected by the sync stages."""
+    with _metrics_lock:
+        METRICS.clear()
+        METRICS.update({'stages': {}, 'queries': 0, 'rows_read': 0, 'bytes_written': 0, 'highlights': 0})
+
+
+def add_metric(name, amount=1):
+    """Add to one of the per-run counters."""
+    with _metrics_lock:
+        METRICS[name] = METRICS.get(name, 0) + amount
+
+
+def add_stage_time(stage, seconds, calls=1):
+    """Add wall time spent in a stage. Stages on worker threads add up."""
+    with _metrics_lock:
+        entry = METRICS['stages'].setdefault(stage, {'seconds': 0.0, 'calls': 0})
+        entry['seconds'] += seconds
+        entry['calls'] += calls
+
+
+@contextmanager
+def measure(stage):
+    """Time the body of a with block as part of ``stage``."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(stage, time.perf_counter() - start)
+
+
+def measure_iter(iterable, stage):
+    """Yield from an iterable, timing each step as part of ``stage``."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            add_stage_time(stage, time.perf_counter() - start, calls=0)
+            return
+        add_stage_time(stage, time.perf_counter() - start)
+        yield item
+
+
+def count_queries(conn):
+    """Count statements run on a connection in the per-run metrics."""
+    conn.set_trace_callback(lambda statement: add_metric('queries'))
+    return conn
+
+
+def metrics_summary(total_seconds):
+    """Return the per-run metrics as a JSON-friendly dict."""
+    with _metrics_lock:
+        summary = json.loads(json.dumps(METRICS))
+    summary['total_seconds'] = round(total_seconds, 6)
+    summary['highlights_per_second'] = round(summary['highlights'] / total_seconds) if total_seconds else 0
+    for entry in summary['stages'].values():
+        entry['seconds'] = round(entry['seconds'], 6)
+    return summary
+
+
+def print_metrics(summary):
+    """Print a per-stage metrics table."""
+    print(f"\n{'Stage':<20}{'seconds':>12}{'calls':>10}")
+    print("-" * 42)
+    for stage, entry in summary['stages'].items():
+        print(f"{stage:<20}{entry['seconds']:>12.4f}{entry['calls']:>10}")
+    print("-" * 42)
+    print(f"{'total':<20}{summary['total_seconds']:>12.4f}")
+    print(f"\nSQL queries: {summary['queries']}")
+    print(f"Rows read: {summary['rows_read']}")
+    print(f"Bytes written: {summary['bytes_written']}")
+    print(f"Highlights: {summary['highlights']} ({summary['highlights_per_second']}/s)")
+
+
+def get_pocketbook_path(config, path=None, batch=False):
+    """Find or prompt for Pocketbook mount path.
+
+    An explicit ``path`` (from --device or POCKETBOOK_SYNC_DEVICE) wins over
+    the config file and auto-detection. In ``batch`` mode the user is never
+    prompted; the sync exits with EXIT_NO_DEVICE instead.
+    """
+    if path:
+        path = Path(path).expanduser()
+        db_path = path / 'system' / 'config' / 'books.db'
+        if db_path.exists():
+            print(f"Using Pocketbook path: {path}")
+            return path
+        print(f"Error: Could not find books.db at {db_path}")
+        sys.exit(EXIT_NO_DEVICE)
 
     if 'pocketbook_path' in config:
         path = Path(config['pocketbook_path'])
@@ -40,13 +363,7 @@ def get_pocketbook_path():
             return path
 
     # Try to auto-detect common mount points on macOS
-    common_paths = [
-        Path('/Volumes/PB626'),
-        Path('/Volumes/PocketBook'),
-        Path('/Volumes/POCKETBOOK'),
-    ]
-
-    for path in common_paths:
+    for path in POCKETBOOK_MOUNT_POINTS:
         if path.exists():
             db_path = path / 'system' / 'config' / 'books.db'
             if db_path.exists():
@@ -55,6 +372,10 @@ def get_pocketbook_path():
                 save_config(config)
                 return path
 
+    if batch:
+        print("Error: Pocketbook device not found. Is it connected and mounted?")
+        sys.exit(EXIT_NO_DEVICE)
+
     # Prompt user
     print("\nPocketbook device not auto-detected.")
     print("Please connect your Pocketbook via USB and enter the mount path.")
@@ -74,9 +395,59 @@ def get_pocketbook_path():
             print("Please check the path and try again.")
 
 
-def get_obsidian_path():
-    """Get or prompt for Obsidian vault path."""
-    config = load_config()
+def list_mount_points():
+    """Return the directories removable volumes are currently mounted on.
+
+    Reads the Linux mount table for FAT/exFAT/NTFS filesystems and lists
+    the volumes under /Volumes on macOS. Both are cheap enough to poll.
+    """
+    mounts = set()
+    try:
+        with open(MOUNTS_FILE, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3 and fields[2] in REMOVABLE_FS_TYPES:
+                    # Spaces and other special characters are octal-escaped
+                    mount = MOUNT_ESCAPE_PATTERN.sub(lambda m: chr(int(m.group(1), 8)), fields[1])
+                    mounts.add(Path(mount))
+    except OSError:
+        pass
+    try:
+        mounts.update(path for path in VOLUMES_DIR.iterdir() if path.is_dir())
+    except OSError:
+        pass
+    return mounts
+
+
+def find_pocketbooks(extra_paths=()):
+    """Return ``{books.db path: mount path}`` for every mounted Pocketbook.
+
+    ``extra_paths`` are checked in addition to the mounted volumes, e.g. the
+    configured pocketbook_path or --device.
+    """
+    found = {}
+    candidates = list_mount_points() | set(POCKETBOOK_MOUNT_POINTS)
+    candidates.update(Path(path).expanduser() for path in extra_paths if path)
+    for mount in candidates:
+        db_path = mount / 'system' / 'config' / 'books.db'
+        if db_path.is_file():
+            found[db_path] = mount
+    return found
+
+
+def get_obsidian_path(config, path=None, batch=False):
+    """Get or prompt for Obsidian vault path.
+
+    ``path`` and ``batch`` work as in get_pocketbook_path(); a missing
+    vault exits with EXIT_NO_VAULT.
+    """
+    if path:
+        path = Path(path).expanduser()
+        if path.is_dir():
+            print(f"Using Obsidian vault: {path}")
+            return path
+        print(f"Error: Directory not found at {path}")
+        sys.exit(EXIT_NO_VAULT)
 
     if 'obsidian_vault_path' in config:
         path = Path(config['obsidian_vault_path'])
@@ -84,6 +455,10 @@ def get_obsidian_path():
             print(f"Using Obsidian vault: {path}")
             return path
 
+    if batch:
+        print("Error: No Obsidian vault found. Set obsidian_vault_path in the config file or pass --vault.")
+        sys.exit(EXIT_NO_VAULT)
+
     print("\nEnter the path to your Obsidian vault.")
 
     while True:
@@ -99,9 +474,21 @@ def get_obsidian_path():
             print("Please check the path and try again.")
 
 
-def get_calibre_library_path():
-    """Get or prompt for Calibre library path."""
-    config = load_config()
+def get_calibre_library_path(config, path=None, batch=False):
+    """Get or prompt for Calibre library path.
+
+    Calibre is optional, so a missing library never stops the sync: an
+    explicit ``path`` that doesn't exist only warns, and ``batch`` mode
+    carries on without backlinks instead of prompting.
+    """
+    if path:
+        path = Path(path).expanduser()
+        if path.is_dir():
+            print(f"Using Calibre library: {path}")
+            return path
+        print(f"Warning: Calibre library not found at {path}")
+        print("Continuing without backlinks...")
+        return None
 
     if 'calibre_library_path' in config:
         path = Path(config['calibre_library_path'])
@@ -119,6 +506,10 @@ def get_calibre_library_path():
             save_config(config)
             return default_path
 
+    if batch:
+        print("No Calibre library found, continuing without backlinks.")
+        return None
+
     print("\nEnter the path to your Calibre library (or press Enter to skip backlinks).")
 
     user_path = input("Calibre library path (optional): ").strip()
@@ -136,187 +527,1274 @@ def get_calibre_library_path():
         return None
 
 
+def normalize_text(text):
+    """Casefold text and strip diacritics and punctuation for matching."""
+    text = text or ''
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(NON_WORD_PATTERN.sub(' ', text.casefold()).split())
+
+
+def title_variants(title):
+    """Return the normalized title with and without its subtitle."""
+    variants = {normalize_text(title)}
+    main_title = SUBTITLE_PATTERN.split(title or '', 1)[0]
+    if main_title != title:
+        variants.add(normalize_text(main_title))
+    variants.discard('')
+    return variants
+
+
+def trigrams(text):
+    """Return the set of character trigrams of a normalized string."""
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def title_profiles(variants):
+    """Precompute ``(variant, trigrams, numbers)`` for each title variant."""
+    return [(variant, trigrams(variant), NUMBER_PATTERN.findall(variant)) for variant in variants]
+
+
+def title_similarity(query_profiles, candidate_profiles):
+    """Score two lists of title_profiles() between 0 and 1."""
+    best = 0.0
+    for query, query_trigrams, query_numbers in query_profiles:
+        for candidate, candidate_trigrams, candidate_numbers in candidate_profiles:
+            if query == candidate:
+                return 1.0
+            shared = len(query_trigrams & candidate_trigrams)
+            score = 2.0 * shared / (len(query_trigrams) + len(candidate_trigrams))
+            # One title is the other plus extra words, e.g. an edition note.
+            # Scaled by how much of the longer title matches, so "It" is not
+            # "It Ends with Us"; subtitles already match via title_variants()
+            if f" {query} " in f" {candidate} " or f" {candidate} " in f" {query} ":
+                shorter, longer = sorted((len(query), len(candidate)))
+                score = max(score, 0.9 * shorter / longer)
+            # Different numbers usually mean a different volume or edition
+            if query_numbers != candidate_numbers:
+                score *= 0.5
+            best = max(best, score)
+    return best
+
+
+def author_tokens(authors):
+    """Return the set of name tokens in an author string."""
+    if not authors or authors == 'Unknown Author':
+        return set()
+    return set(normalize_text(authors).split())
+
+
+def scan_epub_files(calibre_db_path):
+    """Return the library-relative paths of every EPUB in one directory walk.
+
+    Listing directories does not download iCloud files, so this replaces a
+    per-book ``exists()`` that can block on file materialization. Hidden
+    folders such as Calibre's .caltrash are skipped.
+    """
+    found = set()
+    for dirpath, dirnames, filenames in os.walk(calibre_db_path):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        relative = Path(dirpath).relative_to(calibre_db_path).as_posix()
+        for name in filenames:
+            if name.lower().endswith('.epub'):
+                found.add(unicodedata.normalize('NFC', f"{relative}/{name}"))
+    return found
+
+
+def read_calibre_entries(calibre_db_path):
+    """Read Calibre's EPUB books and authors into match index entries."""
+    conn = count_queries(sqlite3.connect(calibre_db_path / 'metadata.db'))
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute("""
+            SELECT books.id, books.title, books.path, data.format, data.name,
+                   GROUP_CONCAT(authors.name, ' & ') as authors
+            FROM books
+            JOIN data ON books.id = data.book
+            LEFT JOIN books_authors_link ON books_authors_link.book = books.id
+            LEFT JOIN authors ON authors.id = books_authors_link.author
+            WHERE data.format = 'EPUB'
+            GROUP BY books.id, data.id
+            ORDER BY books.id
+        """).fetchall()
+    finally:
+        conn.close()
+    add_metric('rows_read', len(rows))
+
+    epub_files = scan_epub_files(calibre_db_path)
+    entries = []
+    for row in rows:
+        info = calibre_info_from_row(row)
+        info['epub_exists'] = unicodedata.normalize('NFC', f"{row['path']}/{row['name']}.epub") in epub_files
+        entries.append({
+            'info': info,
+            'titles': title_variants(row['title']),
+            'authors': author_tokens(row['authors'])
+        })
+    return entries
+
+
+def index_calibre_entries(entries):
+    """Build the in-memory match index over read_calibre_entries() entries."""
+    index = {'entries': entries, 'exact': {}, 'normalized': {}, 'tokens': {}, 'profiles': {}}
+    for entry_id, entry in enumerate(entries):
+        index['exact'].setdefault(entry['info']['title'], entry_id)
+        for variant in entry['titles']:
+            index['normalized'].setdefault(variant, []).append(entry_id)
+            for token in variant.split():
+                postings = index['tokens'].setdefault(token, [])
+                if not postings or postings[-1] != entry_id:
+                    postings.append(entry_id)
+    return index
+
+
+def build_calibre_index(calibre_db_path):
+    """Read Calibre's EPUB books and authors once into an in-memory match index."""
+    return index_calibre_entries(read_calibre_entries(calibre_db_path))
+
+
+def load_calibre_cache(cache_path, signature):
+    """Return the cached Calibre match index if it was built for ``signature``."""
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    except (ValueError, OSError):
+        return None
+    if cache.get('signature') != signature:
+        return None
+
+    entries = [
+        {
+            'info': {'id': book_id, 'title': title, 'path': path, 'format': book_format,
+                     'filename': filename, 'epub_exists': epub_exists},
+            'titles': set(titles),
+            'authors': set(authors)
+        }
+        for book_id, title, path, book_format, filename, epub_exists, titles, authors in cache['entries']
+    ]
+    return {'entries': entries, 'exact': cache['exact'], 'normalized': cache['normalized'],
+            'tokens': cache['tokens'], 'profiles': {}}
+
+
+def save_calibre_cache(cache_path, signature, index):
+    """Save a Calibre match index (without its lazy title profiles) locally."""
+    cache = {
+        'signature': signature,
+        'entries': [
+            [entry['info']['id'], entry['info']['title'], entry['info']['path'], entry['info']['format'],
+             entry['info']['filename'], entry['info']['epub_exists'],
+             sorted(entry['titles']), sorted(entry['authors'])]
+            for entry in index['entries']
+        ],
+        'exact': index['exact'],
+        'normalized': index['normalized'],
+        'tokens': index['tokens']
+    }
+    tmp_path = cache_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, separators=(',', ':'))
+    os.replace(tmp_path, cache_path)
+
+
+def match_calibre_index(index, book_title, book_author, threshold=CALIBRE_MATCH_THRESHOLD):
+    """Find the best Calibre match for a book in a build_calibre_index() index.
+
+    Candidates come from shared title words, rarest first, and are scored
+    by title trigram similarity weighted by author agreement. Returns the
+    calibre_info with a ``score`` key, or None below ``threshold``.
+    """
+    entries = index['entries']
+    query_authors = author_tokens(book_author)
+
+    def result(entry_id, score):
+        info = dict(entries[entry_id]['info'])
+        info['score'] = round(score, 3)
+        return info
+
+    def author_weight(entry):
+        # Books by different authors that share a title are not a match
+        if not query_authors or not entry['authors']:
+            return 1.0
+        overlap = len(query_authors & entry['authors']) / min(len(query_authors), len(entry['authors']))
+        return 0.8 + 0.2 * overlap if overlap else CALIBRE_AUTHOR_MISMATCH
+
+    exact_id = index['exact'].get(book_title)
+    if exact_id is not None and author_weight(entries[exact_id]) > CALIBRE_AUTHOR_MISMATCH:
+        return result(exact_id, 1.0)
+
+    query_variants = title_variants(book_title)
+    candidates = {}
+    for variant in query_variants:
+        for entry_id in index['normalized'].get(variant, ()):
+            candidates[entry_id] = 1.0
+
+    # Otherwise rank books by the summed rarity of the title words they
+    # share. Very common words are only used when nothing rarer matched.
+    if not candidates:
+        postings_lists = sorted(
+            (index['tokens'][token] for variant in query_variants for token in set(variant.split())
+             if token in index['tokens']),
+            key=len
+        )
+        for postings in postings_lists:
+            if len(postings) > CALIBRE_MAX_POSTINGS and candidates:
+                break
+            weight = 1.0 / len(postings)
+            for entry_id in postings[:CALIBRE_MAX_POSTINGS]:
+                candidates[entry_id] = candidates.get(entry_id, 0.0) + weight
+
+    shortlist = heapq.nlargest(CALIBRE_MAX_CANDIDATES, candidates, key=candidates.get)
+    query_profiles = title_profiles(query_variants)
+
+    best_id, best_score = None, 0.0
+    for entry_id in shortlist:
+        entry = entries[entry_id]
+        profiles = index['profiles'].get(entry_id)
+        if profiles is None:
+            profiles = index['profiles'][entry_id] = title_profiles(entry['titles'])
+        score = title_similarity(query_profiles, profiles) * author_weight(entry)
+        if score > best_score:
+            best_id, best_score = entry_id, score
+
+    if best_id is None or best_score < threshold:
+        return None
+    return result(best_id, best_score)
+
+
+def calibre_info_from_row(row):
+    """Build the calibre_info dict used for backlinks from a result row."""
+    return {
+        'id': row['id'],
+        'title': row['title'],
+        'path': row['path'],
+        'format': row['format'],
+        'filename': row['name']
+    }
+
+
+def load_calibre_index(calibre_db_path, cache_dir=SNAPSHOT_DIR):
+    """Build the Calibre match index, or return None if it is unavailable.
+
+    The books read from metadata.db are cached locally and reused until
+    metadata.db's size or mtime changes, so an unchanged library is not
+    re-read or re-scanned from a slow (e.g. iCloud) drive.
+    """
+    if not calibre_db_path or not calibre_db_path.exists():
+        return None
+
+    source_key = hashlib.sha1(str(calibre_db_path.resolve()).encode('utf-8')).hexdigest()[:12]
+    cache_path = cache_dir / f"calibre-{source_key}.json"
+    signature = {
+        'version': CALIBRE_CACHE_VERSION,
+        'source': str(calibre_db_path),
+        'metadata': file_signature(calibre_db_path / 'metadata.db')
+    }
+
+    try:
+        with measure('calibre_index'):
+            index = load_calibre_cache(cache_path, signature)
+            if index is None:
+                index = build_calibre_index(calibre_db_path)
+                try:
+                    cache_dir.mkdir(parents=True, exist_ok=True)
+                    save_calibre_cache(cache_path, signature, index)
+                except OSError as e:
+                    print(f"Warning: could not cache Calibre library: {e}")
+            return index
+    except sqlite3.Error as e:
+        print(f"Calibre database error: {e}")
+        return None
+
+
+def lookup_calibre_books(calibre_db_path, books, cache_dir=SNAPSHOT_DIR):
+    """Look up many books in the Calibre library from a single index build.
+
+    ``books`` is an iterable of ``(title, author)`` pairs. Returns a dict
+    mapping each matched title to its calibre_info; unmatched titles are
+    left out.
+    """
+    index = load_calibre_index(calibre_db_path, cache_dir)
+    if index is None:
+        return {}
+
+    matches = {}
+    for title, author in books:
+        if title not in matches:
+            calibre_info = match_calibre_index(index, title, author)
+            if calibre_info:
+                matches[title] = calibre_info
+    return matches
+
+
+def match_calibre_books(books, calibre_db_path, cache_dir=SNAPSHOT_DIR):
+    """Pair each book from an iterable with its calibre_info as it arrives.
+
+    Yields ``(book, calibre_info)``. The Calibre index is built once up
+    front, or loaded from its cache in ``cache_dir``; calibre_info is None
+    when the library is unavailable or has no match.
+    """
+    index = load_calibre_index(calibre_db_path, cache_dir)
+    for book in books:
+        calibre_info = None
+        if index is not None:
+            with measure('calibre_match'):
+                calibre_info = match_calibre_index(index, book.title, book.author)
+        yield book, calibre_info
+
+
 def lookup_calibre_book(calibre_db_path, book_title, book_author):
     """Look up book ID and path in Calibre library."""
-    if not calibre_db_path or not calibre_db_path.exists():
+    return lookup_calibre_books(calibre_db_path, [(book_title, book_author)]).get(book_title)
+
+
+class Highlight(NamedTuple):
+    """One highlight from books.db.
+
+    A tuple costs a fraction of an equivalent dict, which adds up over the
+    hundreds of thousands of highlights in a large library.
+    """
+    id: Union[int, str]  # device OID, "<source>-<OID>" for extra sources
+    text: str
+    annotation: Optional[str] = None
+    position: Optional[int] = None
+    epubcfi: Optional[str] = None
+    timestamp: Optional[int] = None
+    type: str = 'highlight'
+
+
+class Book(NamedTuple):
+    """A book and its highlights, in reading order."""
+    title: str
+    author: str
+    highlights: list
+
+
+class EpubCfi(NamedTuple):
+    """The parts of an EPUB CFI that place it in reading order.
+
+    ``steps`` are the child indexes along its path, across indirections;
+    ``spine`` is the spine step of the chapter it points into (the last
+    step before the first "!"), or None; ``offset`` is the character
+    offset, 0 if there is none. A range CFI is reduced to its start.
+    """
+    steps: tuple
+    spine: Optional[int]
+    offset: int
+
+
+def parse_epubcfi(cfi):
+    """Parse ``epubcfi(...)`` or a bare CFI path; return an EpubCfi, or None if invalid."""
+    if not cfi:
+        return None
+    if cfi.startswith('epubcfi(') and cfi.endswith(')'):
+        cfi = cfi[8:-1]
+
+    if EPUBCFI_COMPLEX_PATTERN.search(cfi) is None:
+        path, _, offset = cfi.partition(':')
+        if not path.startswith('/') or path.count('!') != path.count('!/'):
+            return None
+        spine_path, indirection, _ = path.partition('!')
+        try:
+            return EpubCfi(
+                tuple(map(int, path[1:].replace('!/', '/').split('/'))),
+                int(spine_path[spine_path.rfind('/') + 1:]) if indirection else None,
+                int(offset) if offset else 0
+            )
+        except ValueError:
+            return None
+
+    steps = []
+    spine = None
+    offset = 0
+    position = 0
+    ranges = 0
+    while position < len(cfi):
+        match = EPUBCFI_TOKEN_PATTERN.match(cfi, position)
+        if match is None:
+            return None
+        step, indirection, char_offset, comma = match.groups()
+        if step is not None:
+            steps.append(int(step))
+        elif indirection:
+            if spine is None and steps:
+                spine = steps[-1]
+        elif char_offset is not None:
+            offset = int(char_offset)
+        elif comma:
+            # "parent,start,end": the start continues the parent path
+            ranges += 1
+            if ranges == 2:
+                break
+        position = match.end()
+
+    if not steps or not cfi.startswith('/'):
         return None
+    return EpubCfi(tuple(steps), spine, offset)
+
+
+def reading_order_key(highlight):
+    """Sort key putting a book's highlights in reading order.
 
+    CFIs are compared step by step, so a position precedes everything
+    inside it, then by character offset. Highlights without a valid CFI
+    come last, by page. Sorting is stable, so ties keep creation order.
+    """
+    cfi = parse_epubcfi(highlight.epubcfi)
+    if cfi is None:
+        return 1, (highlight.position or 0,), 0
+    return 0, cfi.steps, cfi.offset
+
+
+def sort_reading_order(books):
+    """Yield each book with its highlights in reading order rather than creation order."""
+    for book in books:
+        yield book._replace(highlights=sorted(book.highlights, key=reading_order_key))
+
+
+def has_json1(conn):
+    """Check whether this SQLite build has the JSON1 functions."""
     try:
-        conn = sqlite3.connect(calibre_db_path / 'metadata.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        conn.execute("SELECT json_extract('{}', '$.x')")
+        return True
+    except sqlite3.OperationalError:
+        return False
 
-        # Try exact title match first
-        cursor.execute("""
-            SELECT books.id, books.title, books.path, data.format, data.name
-            FROM books
-            JOIN data ON books.id = data.book
-            WHERE books.title = ? AND data.format = 'EPUB'
-        """, (book_title,))
-
-        result = cursor.fetchone()
-
-        if not result:
-            # Try fuzzy match on title
-            cursor.execute("""
-                SELECT books.id, books.title, books.path, data.format, data.name
-                FROM books
-                JOIN data ON books.id = data.book
-                WHERE books.title LIKE ? AND data.format = 'EPUB'
-                LIMIT 1
-            """, (f"%{book_title}%",))
-            result = cursor.fetchone()
 
-        conn.close()
+def tag_ids_query(count):
+    """Build the TagNames lookup for ``count`` tag names."""
+    placeholders = ', '.join('?' for _ in range(count))
+    return f"SELECT TagName, OID FROM TagNames WHERE TagName IN ({placeholders})"
+
+
+def get_tag_ids(cursor, tag_names):
+    """Resolve TagNames to their OIDs in a single query."""
+    cursor.execute(tag_ids_query(len(tag_names)), tuple(tag_names))
+    return {row['TagName']: row['OID'] for row in cursor.fetchall()}
 
-        if result:
-            return {
-                'id': result['id'],
-                'title': result['title'],
-                'path': result['path'],
-                'format': result['format'],
-                'filename': result['name']
-            }
 
+def file_signature(path):
+    """Return size and mtime of a file, or None if it does not exist."""
+    try:
+        stat = path.stat()
+    except OSError:
         return None
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
 
-    except sqlite3.Error as e:
-        print(f"Calibre database error: {e}")
+
+def database_fingerprint(db_path):
+    """Return a cheap fingerprint of books.db, or None if it is missing.
+
+    Size and mtime come from stat(). The file change counter in the 100-byte
+    SQLite header goes up with every committed write. The WAL's signature is
+    included because writes in WAL mode reach the main file only at a
+    checkpoint.
+    """
+    db_path = Path(db_path)
+    signature = file_signature(db_path)
+    if signature is None:
         return None
+    try:
+        with open(db_path, 'rb') as f:
+            header = f.read(100)
+    except OSError:
+        return None
+    if len(header) < 100 or not header.startswith(b'SQLite format 3\x00'):
+        return None
+    return {
+        **signature,
+        'change_counter': int.from_bytes(header[24:28], 'big'),
+        'wal': file_signature(db_path.with_name(db_path.name + '-wal'))
+    }
+
+
+def index_snapshot(snapshot_path):
+    """Build SNAPSHOT_INDEXES on a local snapshot and refresh its statistics.
+
+    Indexes whose columns are missing from this database are skipped.
+    Returns the names of the indexes that exist afterwards.
+    """
+    conn = sqlite3.connect(snapshot_path)
+    try:
+        built = []
+        for name, table, columns in SNAPSHOT_INDEXES:
+            table_columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            if not set(columns) <= table_columns:
+                continue
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({', '.join(columns)})")
+            built.append(name)
+        conn.execute("ANALYZE")
+        conn.commit()
+        return built
+    finally:
+        conn.close()
 
 
-def extract_highlights(db_path):
-    """Extract highlights from Pocketbook books.db database."""
-    conn = sqlite3.connect(db_path)
+def source_label(db_path):
+    """Return a short, stable label for a books.db path."""
+    return hashlib.sha1(str(Path(db_path).resolve()).encode('utf-8')).hexdigest()[:12]
+
+
+def cached_snapshot_path(db_path, cache_dir=SNAPSHOT_DIR):
+    """Return where snapshot_database() keeps the snapshot of ``db_path``."""
+    return cache_dir / f"books-{source_label(db_path)}.db"
+
+
+def snapshot_database(db_path, cache_dir=SNAPSHOT_DIR, index=False):
+    """Copy books.db (and its WAL) to a local snapshot for extraction.
+
+    The device is read with one sequential copy per file, then the SQLite
+    backup API folds any WAL content into a single self-contained snapshot
+    that can be opened immutable. The copy is skipped when the source size
+    and mtime match the previous snapshot.
+
+    With ``index=True`` the snapshot also gets SNAPSHOT_INDEXES and fresh
+    ANALYZE statistics. These are kept with the cached snapshot, so they are
+    only rebuilt when the device database changes.
+    """
+    db_path = Path(db_path)
+    wal_path = db_path.with_name(db_path.name + '-wal')
+    source_key = source_label(db_path)
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    snapshot_path = cached_snapshot_path(db_path, cache_dir)
+    meta_path = cache_dir / f"books-{source_key}.json"
+
+    signature = {
+        'source': str(db_path),
+        'db': file_signature(db_path),
+        'wal': file_signature(wal_path)
+    }
+
+    if snapshot_path.exists() and meta_path.exists():
+        try:
+            with open(meta_path, 'r') as f:
+                cached = json.load(f)
+            indexed = cached.pop('indexes', None)
+            if cached == signature:
+                if indexed is not None or not index:
+                    print("Device database unchanged, using cached snapshot.")
+                    return snapshot_path
+                print("Device database unchanged, indexing cached snapshot.")
+                signature['indexes'] = index_snapshot(snapshot_path)
+                with open(meta_path, 'w') as f:
+                    json.dump(signature, f, indent=2)
+                return snapshot_path
+        except (ValueError, OSError, AttributeError):
+            pass
+
+    import shutil
+    raw_dir = cache_dir / f"books-{source_key}.raw"
+    if raw_dir.exists():
+        shutil.rmtree(raw_dir)
+    raw_dir.mkdir()
+
+    try:
+        raw_db = raw_dir / db_path.name
+        shutil.copyfile(db_path, raw_db)
+        if signature['wal']:
+            shutil.copyfile(wal_path, raw_dir / wal_path.name)
+
+        tmp_snapshot = snapshot_path.with_suffix('.tmp')
+        src = sqlite3.connect(raw_db)
+        dst = sqlite3.connect(tmp_snapshot)
+        try:
+            src.backup(dst)
+            dst.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            dst.close()
+            src.close()
+        if index:
+            signature['indexes'] = index_snapshot(tmp_snapshot)
+        os.replace(tmp_snapshot, snapshot_path)
+    finally:
+        shutil.rmtree(raw_dir, ignore_errors=True)
+
+    with open(meta_path, 'w') as f:
+        json.dump(signature, f, indent=2)
+
+    return snapshot_path
+
+
+def open_books_db(db_path, immutable=False):
+    """Open books.db, read-only and memory-mapped when it is a local snapshot."""
+    if not immutable:
+        return count_queries(sqlite3.connect(db_path))
+
+    uri = f"{Path(db_path).resolve().as_uri()}?mode=ro&immutable=1"
+    conn = count_queries(sqlite3.connect(uri, uri=True))
+    conn.execute(f"PRAGMA mmap_size = {SNAPSHOT_MMAP_SIZE}")
+    return conn
+
+
+def get_highlight_watermark(db_path, immutable=False):
+    """Return the highest highlight OID and TimeAlt currently in books.db."""
+    conn = open_books_db(db_path, immutable)
+    try:
+        max_oid, max_time = conn.execute(WATERMARK_QUERY).fetchone()
+        return {'max_oid': max_oid or 0, 'max_time': max_time or 0}
+    finally:
+        conn.close()
+
+
+def get_highlight_counts(db_path, immutable=False):
+    """Return ``{parent_id: count}`` of highlight items per book in books.db.
+
+    Keys are strings, as they are saved in the JSON sync state.
+    """
+    conn = open_books_db(db_path, immutable)
+    try:
+        return {str(parent): count for parent, count in conn.execute(HIGHLIGHT_COUNTS_QUERY)}
+    finally:
+        conn.close()
+
+
+def changed_highlight_counts(old_counts, new_counts):
+    """Return the parent IDs whose highlight count differs between two counts."""
+    return sorted(
+        int(parent) for parent in set(old_counts) | set(new_counts)
+        if old_counts.get(parent) != new_counts.get(parent)
+    )
+
+
+def build_highlights_query(use_json1=True, incremental=False, changed_parents=0):
+    """Build the single query iter_books() extracts highlights with.
+
+    ``incremental`` adds the filter for books changed since a watermark,
+    plus ``changed_parents`` books named by ID, e.g. ones that lost a
+    highlight. Parameters are named; see highlights_query_params().
+    """
+    if use_json1:
+        # Malformed JSON would abort the query, so json_valid() guards
+        # every json_extract() inside a CASE
+        quotation_columns = """
+        CASE WHEN json_valid(Tags.Val) THEN json_extract(Tags.Val, '$.text') END as QuoteText,
+        CASE WHEN json_valid(Tags.Val) THEN json_extract(Tags.Val, '$.begin') END as QuoteBegin"""
+        quotation_filter = """
+      AND CASE WHEN json_valid(Tags.Val) THEN json_extract(Tags.Val, '$.text') END != 'Bookmark'
+      AND TRIM(CASE WHEN json_valid(Tags.Val) THEN json_extract(Tags.Val, '$.text') END) != ''"""
+    else:
+        quotation_columns = """
+        Tags.Val as QuotationData,
+        NULL as QuoteBegin"""
+        # Bookmarks are skipped after json.loads(), so this path doesn't
+        # depend on how the device spaces its JSON
+        quotation_filter = ""
+
+    # One query for all bookmark items (type 4) with quotations. Book
+    # metadata is pivoted out of the parent item's tags and the note is
+    # joined in, so the number of queries does not grow with highlights.
+    # Books are grouped by title, so rows are ordered by title first.
+    highlights_query = """{changed_books}
+    SELECT
+        Items.OID as HighlightID,
+        Items.TimeAlt,
+        COALESCE(NULLIF(BookTags.Title, ''), 'Unknown Title') as BookTitle,
+        BookTags.RoAuthors,
+        BookTags.DocAuthors,
+        Notes.Val as NoteText,{quotation_columns}
+    FROM Items
+    JOIN Tags ON Items.OID = Tags.ItemID
+    LEFT JOIN (
+        SELECT
+            ItemID,
+            MAX(CASE WHEN TagID = :title_tag THEN Val END) as Title,
+            MAX(CASE WHEN TagID = :ro_authors_tag THEN Val END) as RoAuthors,
+            MAX(CASE WHEN TagID = :doc_authors_tag THEN Val END) as DocAuthors
+        FROM Tags
+        WHERE TagID IN (:title_tag, :ro_authors_tag, :doc_authors_tag){book_tags_filter}
+        GROUP BY ItemID
+    ) AS BookTags ON BookTags.ItemID = Items.ParentID
+    LEFT JOIN (
+        SELECT ItemID, MIN(Val) as Val
+        FROM Tags
+        WHERE TagID = :note_tag{notes_filter}
+        GROUP BY ItemID
+    ) AS Notes ON Notes.ItemID = Items.OID
+    WHERE {scan}Items.TypeID = 4
+      AND {scan}Tags.TagID = :quotation_tag
+      {quotation_filter}
+      {changed_books_filter}
+    ORDER BY BookTitle, Items.ParentID, Items.TimeAlt
+    """
+
+    # A full extraction reads every highlight, so a unary plus on the
+    # filter columns keeps SQLite scanning Tags rather than seeking once
+    # per item when the snapshot has indexes (see index_snapshot()).
+    scan = '' if incremental else '+'
+
+    # Restrict to books touched since the watermark. Books are grouped
+    # by title, so other parents sharing a changed title come along too.
+    # The book tags and notes are pivoted for those books only, rather
+    # than for every book on the device.
+    changed_books = changed_books_filter = book_tags_filter = notes_filter = ''
+    if incremental:
+        changed_parents_query = """
+        SELECT ParentID FROM Items
+        WHERE TypeID = 4 AND (OID > :since_oid OR TimeAlt > :since_time)"""
+        if changed_parents:
+            parent_params = ', '.join(f":parent_{i}" for i in range(changed_parents))
+            changed_parents_query += f"""
+        UNION
+        SELECT OID FROM Items WHERE OID IN ({parent_params})"""
+        changed_books = f"""
+    WITH ChangedParents AS ({changed_parents_query}
+    ),
+    ChangedBooks AS (
+        SELECT ParentID FROM ChangedParents
+        UNION
+        SELECT ItemID FROM Tags
+        WHERE TagID = :title_tag AND Val IN (
+            SELECT Val FROM Tags
+            WHERE TagID = :title_tag AND ItemID IN ChangedParents
+        )
+    )"""
+        changed_books_filter = """
+      AND Items.ParentID IN ChangedBooks"""
+        book_tags_filter = """
+          AND ItemID IN ChangedBooks"""
+        notes_filter = """
+          AND ItemID IN (SELECT OID FROM Items WHERE ParentID IN ChangedBooks)"""
+
+    return highlights_query.format(
+        changed_books=changed_books,
+        scan=scan,
+        quotation_columns=quotation_columns,
+        quotation_filter=quotation_filter,
+        changed_books_filter=changed_books_filter,
+        book_tags_filter=book_tags_filter,
+        notes_filter=notes_filter
+    )
+
+
+def highlights_query_params(tag_ids, since=None):
+    """Bind get_tag_ids() results and a watermark to build_highlights_query()."""
+    params = {
+        'quotation_tag': tag_ids.get('bm.quotation'),
+        'title_tag': tag_ids.get('doc.book-title'),
+        'ro_authors_tag': tag_ids.get('ro.authors'),
+        'doc_authors_tag': tag_ids.get('doc.authors'),
+        'note_tag': tag_ids.get('bm.note'),
+        'since_oid': since['max_oid'] if since else 0,
+        'since_time': since['max_time'] if since else 0,
+    }
+    for i, parent in enumerate(since.get('parents', ()) if since else ()):
+        params[f"parent_{i}"] = parent
+    return params
+
+
+def iter_books(db_path, since=None, immutable=False, use_json1=None):
+    """Yield books with their highlights from a Pocketbook books.db database.
+
+    Rows come back ordered by book, so each book is yielded as soon as the
+    cursor moves past it and only one book is held in memory at a time.
+    SQLite sorts the rows by title before returning the first one, so the
+    first book arrives about halfway through a full extraction; title order
+    keeps books that share a title together, as merge_books() needs.
+
+    If ``since`` is a watermark dict (``max_oid``/``max_time``), only books
+    that gained or changed a highlight past the watermark are extracted,
+    each with its complete set of highlights. Its optional ``parents`` list
+    adds books by parent ID, e.g. from changed_highlight_counts(). Pass
+    ``immutable=True`` for a local snapshot from snapshot_database().
+
+    Quotation JSON is unpacked by SQLite's JSON1 functions when available
+    (``use_json1=None`` detects it), otherwise by json.loads per row.
+    Raises sqlite3.Error if books.db can't be read, even partway through.
+    """
+    conn = open_books_db(db_path, immutable)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
 
     try:
         # Get TagIDs we need
-        cursor.execute("SELECT OID FROM TagNames WHERE TagName = 'bm.quotation'")
-        quotation_tag_id = cursor.fetchone()['OID']
+        tag_ids = get_tag_ids(cursor, HIGHLIGHT_TAG_NAMES)
+
+        if tag_ids.get('bm.quotation') is None:
+            return
+
+        if use_json1 is None:
+            use_json1 = has_json1(conn)
+
+        # Plain tuples are noticeably cheaper per row than sqlite3.Row
+        cursor.row_factory = None
+        cursor.execute(
+            build_highlights_query(use_json1, incremental=bool(since),
+                                   changed_parents=len(since.get('parents', ())) if since else 0),
+            highlights_query_params(tag_ids, since)
+        )
+
+        book = None
+        rows_read = 0
+
+        for highlight_id, time_alt, title, ro_authors, doc_authors, note_text, quote_text, begin_position in cursor:
+            rows_read += 1
+
+            if not use_json1:
+                # Parse quotation JSON to get the highlighted text and position
+                try:
+                    quotation_data = json.loads(quote_text)
+                    quote_text = quotation_data.get('text', '')
+                    begin_position = quotation_data.get('begin', '')
+                except (ValueError, TypeError, AttributeError):
+                    continue
+                if quote_text == 'Bookmark':
+                    continue
+
+            if not quote_text or not isinstance(quote_text, str):
+                continue
+            highlight_text = quote_text.strip()
+            if not highlight_text:
+                continue
 
-        cursor.execute("SELECT OID FROM TagNames WHERE TagName = 'doc.book-title'")
-        title_tag_id = cursor.fetchone()['OID']
+            # Extract position data (page, EPUB CFI) from e.g.
+            # "pbr:/word?page=243&offs=534#epubcfi(/6/96!/4/40/1:404)"
+            page_num = None
+            epubcfi = None
+            if begin_position and isinstance(begin_position, str):
+                page_match = PAGE_PATTERN.search(begin_position)
+                if page_match:
+                    page_num = int(page_match.group(1))
+
+                epubcfi_match = EPUBCFI_PATTERN.search(begin_position)
+                if epubcfi_match:
+                    epubcfi = epubcfi_match.group(0)
+
+            # Rows are ordered by title, so a new title finishes the last book
+            if book is None or book.title != title:
+                if book is not None:
+                    add_metric('highlights', len(book.highlights))
+                    yield book
+                # Titles and authors are interned: the same strings recur as
+                # state keys and across books by the same author
+                book = Book(sys.intern(str(title)), sys.intern(str(ro_authors or doc_authors or 'Unknown Author')), [])
+
+            book.highlights.append(
+                Highlight(highlight_id, highlight_text, note_text, page_num, epubcfi, time_alt)
+            )
+
+        add_metric('rows_read', rows_read)
+        if book is not None:
+            add_metric('highlights', len(book.highlights))
+            yield book
+
+    finally:
+        conn.close()
 
-        cursor.execute("SELECT OID FROM TagNames WHERE TagName = 'ro.authors'")
-        author_tag_id = cursor.fetchone()['OID']
 
-        cursor.execute("SELECT OID FROM TagNames WHERE TagName = 'bm.note'")
-        note_result = cursor.fetchone()
-        note_tag_id = note_result['OID'] if note_result else None
+def extract_highlights(db_path, since=None, immutable=False):
+    """Extract highlights from Pocketbook books.db database.
+
+    Returns a list of books; see iter_books() for the arguments.
+    """
+    books_with_highlights = list(iter_books(db_path, since=since, immutable=immutable))
+    if not books_with_highlights and not since:
+        print("No highlights found.")
+    return books_with_highlights
+
+
+def resolve_sources(sources, cache_dir=SNAPSHOT_DIR):
+    """Return ``(books.db path, snapshot path or None)`` for each configured source.
+
+    A source is a Pocketbook mount path or a books.db file, such as a backup.
+    A reader that isn't connected falls back to its snapshot from an
+    earlier sync, so its highlights don't vanish from merged notes; the
+    snapshot path is returned for those. Sources with neither are skipped.
+    Exits with EXIT_NO_DEVICE if no source is left.
+    """
+    resolved = []
+    for source in sources:
+        path = Path(source).expanduser()
+        db_path = path / 'system' / 'config' / 'books.db' if path.is_dir() else path
+        if any(db_path == existing for existing, _ in resolved):
+            continue
+        if db_path.is_file():
+            resolved.append((db_path, None))
+            continue
+        snapshot_path = cached_snapshot_path(db_path, cache_dir)
+        if snapshot_path.exists():
+            print(f"Source not connected, using its last snapshot: {source}")
+            resolved.append((db_path, snapshot_path))
+        else:
+            print(f"Warning: No books.db found for source {source}, skipping it.")
 
-        # Query to get all bookmark items (type 4) with quotations
-        highlights_query = """
-        SELECT
-            Items.OID as HighlightID,
-            Items.ParentID,
-            Items.TimeAlt,
-            Tags.Val as QuotationData
-        FROM Items
-        JOIN Tags ON Items.OID = Tags.ItemID
-        WHERE Items.TypeID = 4
-          AND Tags.TagID = ?
-          AND Tags.Val NOT LIKE '%"text":"Bookmark"%'
-        ORDER BY Items.ParentID, Items.TimeAlt
-        """
+    if not resolved:
+        print("\nError: None of the configured sources are available.")
+        sys.exit(EXIT_NO_DEVICE)
+    return resolved
 
-        cursor.execute(highlights_query, (quotation_tag_id,))
-        highlights = cursor.fetchall()
 
-        if not highlights:
-            print("No highlights found.")
-            conn.close()
-            return []
+def iter_in_thread(iterable, executor, buffer=SOURCE_PREFETCH_BOOKS):
+    """Consume ``iterable`` on ``executor`` and yield its items from a bounded queue.
 
-        # Group highlights by book
-        books_dict = {}
+    The worker stays at most ``buffer`` items ahead. Closing this generator
+    stops the worker at its next item.
+    """
+    import queue
 
-        for highlight in highlights:
-            parent_id = highlight['ParentID']
+    items = queue.Queue(maxsize=buffer)
+    stop = threading.Event()
+    done = object()
 
-            # Get book metadata from parent item
-            cursor.execute("""
-                SELECT Tags.Val, TagNames.TagName
-                FROM Tags
-                JOIN TagNames ON Tags.TagID = TagNames.OID
-                WHERE Tags.ItemID = ?
-                  AND TagNames.TagName IN ('doc.book-title', 'ro.authors', 'doc.authors')
-            """, (parent_id,))
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-            book_tags = {row['TagName']: row['Val'] for row in cursor.fetchall()}
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+        else:
+            put((done, None))
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
 
-            title = book_tags.get('doc.book-title', 'Unknown Title')
-            author = book_tags.get('ro.authors', book_tags.get('doc.authors', 'Unknown Author'))
+    executor.submit(produce)
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def extract_source(db_path, snapshot_path=None, snapshot=True, index=False):
+    """Yield every book in one source, snapshotting it first unless ``snapshot`` is False.
+
+    ``snapshot_path`` reads an existing snapshot instead of the database,
+    as resolve_sources() returns for a disconnected reader.
+    """
+    if snapshot_path is None and snapshot:
+        with measure('snapshot'):
+            snapshot_path = snapshot_database(db_path, index=index)
+    if snapshot_path is None:
+        yield from iter_books(db_path)
+    else:
+        yield from iter_books(snapshot_path, immutable=True)
+
+
+def qualify_highlight_ids(books, label):
+    """Prefix highlight IDs with a source label so OIDs from two readers can't collide."""
+    for book in books:
+        yield book._replace(highlights=[
+            highlight._replace(id=f"{label}-{highlight.id}") for highlight in book.highlights
+        ])
+
+
+def highlight_identity(highlight):
+    """Return what makes two highlights the same across readers.
+
+    The text is compared with Unicode and whitespace normalized. The EPUB
+    CFI is compared when there is one, since page numbers depend on each
+    reader's font settings.
+    """
+    text = highlight.text
+    # Most highlights are plain ASCII with single spaces; skip the
+    # normalize/split/join round trip for those.
+    if not text.isascii():
+        text = ' '.join(unicodedata.normalize('NFC', text).split())
+    elif '  ' in text or '\n' in text or '\t' in text or '\r' in text:
+        text = ' '.join(text.split())
+    return text.casefold(), highlight.epubcfi or highlight.position
+
+
+def merge_books(streams):
+    """Merge title-ordered book streams into one, dropping duplicate highlights.
+
+    Books with the same title are combined into one book, ordered by
+    timestamp. When a highlight appears in several streams, the copy from
+    the earliest stream is kept.
+    """
+    for title, group in itertools.groupby(heapq.merge(*streams, key=attrgetter('title')),
+                                          key=attrgetter('title')):
+        books = list(group)
+        if len(books) == 1:
+            yield books[0]
+            continue
+
+        seen = set()
+        highlights = []
+        for book in books:
+            for highlight in book.highlights:
+                identity = highlight_identity(highlight)
+                if identity not in seen:
+                    seen.add(identity)
+                    highlights.append(highlight)
+        highlights.sort(key=lambda highlight: highlight.timestamp or 0)
+
+        author = next((book.author for book in books if book.author), books[0].author)
+        yield Book(title, author, highlights)
+
+
+def extract_sources(sources, store=None, snapshot=True, index=False):
+    """Extract several sources concurrently and yield one merged, deduplicated stream.
+
+    ``sources`` comes from resolve_sources(). Each source is snapshotted and
+    extracted on its own thread, so the total time approaches the slowest
+    source. The store keeps each source's highlights under its own OIDs.
+    Highlights from every source after the first get qualified IDs; see
+    qualify_highlight_ids().
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        streams = []
+        for number, (db_path, snapshot_path) in enumerate(sources):
+            books = measure_iter(extract_source(db_path, snapshot_path, snapshot, index), 'extract')
+            books = iter_in_thread(books, executor)
+            if store is not None:
+                books = store_books(books, store, str(db_path), full=True)
+            if number:
+                books = qualify_highlight_ids(books, source_label(db_path))
+            streams.append(books)
+        try:
+            yield from merge_books(streams)
+        finally:
+            # Stop the workers before the executor waits for them
+            for books in streams:
+                books.close()
+
+
+def book_state(book):
+    """Summarize a book's highlights for incremental sync state."""
+    highlights = book.highlights
+    digest = hashlib.sha1(
+        json.dumps([book.author, [h._asdict() for h in highlights]], sort_keys=True).encode('utf-8')
+    ).hexdigest()
+    return {
+        # Qualified "<source>-<OID>" IDs from extra sources don't count
+        'max_oid': max((h.id for h in highlights if isinstance(h.id, int)), default=0),
+        'max_time': max(h.timestamp or 0 for h in highlights),
+        'hash': digest
+    }
+
+
+def render_fingerprint(note_format, template_sources, merge, shard_min, reading_order, calibre_library_path):
+    """Summarize the settings notes are rendered with, for incremental sync state.
+
+    Saved book hashes only say a book's highlights are unchanged; when these
+    settings change, every note is out of date anyway.
+    """
+    settings = [note_format, template_sources, merge, shard_min, reading_order,
+                str(calibre_library_path) if calibre_library_path else None]
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def add_emptied_books(books, titles):
+    """Pass books through, then yield an empty Book for each of ``titles`` not seen.
+
+    After a full extraction these are books whose highlights were all
+    deleted on the device, so their notes can be cleaned up.
+    """
+    seen = set()
+    for book in books:
+        seen.add(book.title)
+        yield book
+    for title in sorted(titles - seen):
+        yield Book(title, 'Unknown Author', [])
+
+
+def filter_changed_books(books, book_states, new_book_states):
+    """Yield only books whose highlight set differs from the saved state.
+
+    The state of every book seen is recorded in ``new_book_states``. Books
+    without highlights, from add_emptied_books(), are passed through
+    unrecorded.
+    """
+    for book in books:
+        if not book.highlights:
+            yield book
+            continue
+        new_state = book_state(book)
+        new_book_states[book.title] = new_state
+        if book_states.get(book.title, {}).get('hash') != new_state['hash']:
+            yield book
+
+
+def open_highlight_store(store_path=STORE_FILE):
+    """Open the local highlight store, creating it on first use.
+
+    Every synced highlight is kept here, keyed by its source database and
+    device OID, with an FTS5 index for the search command. Returns None if
+    this SQLite build has no FTS5.
+    """
+    # The sync pipeline stores books from its extraction thread, then
+    # commits from the main thread once extraction has finished
+    conn = sqlite3.connect(store_path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS highlights (
+                id INTEGER PRIMARY KEY,
+                source TEXT NOT NULL,
+                oid INTEGER NOT NULL,
+                book TEXT NOT NULL,
+                author TEXT,
+                text TEXT NOT NULL,
+                note TEXT,
+                page INTEGER,
+                epubcfi TEXT,
+                timestamp INTEGER,
+                UNIQUE (source, oid)
+            );
+            CREATE INDEX IF NOT EXISTS highlights_book ON highlights (source, book);
+
+            CREATE VIRTUAL TABLE IF NOT EXISTS highlights_fts USING fts5(
+                text, note, book, author,
+                content='highlights', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            );
+
+            -- Keep the external-content FTS index in step with the table
+            CREATE TRIGGER IF NOT EXISTS highlights_ai AFTER INSERT ON highlights BEGIN
+                INSERT INTO highlights_fts (rowid, text, note, book, author)
+                VALUES (new.id, new.text, new.note, new.book, new.author);
+            END;
+            CREATE TRIGGER IF NOT EXISTS highlights_ad AFTER DELETE ON highlights BEGIN
+                INSERT INTO highlights_fts (highlights_fts, rowid, text, note, book, author)
+                VALUES ('delete', old.id, old.text, old.note, old.book, old.author);
+            END;
+            CREATE TRIGGER IF NOT EXISTS highlights_au AFTER UPDATE ON highlights BEGIN
+                INSERT INTO highlights_fts (highlights_fts, rowid, text, note, book, author)
+                VALUES ('delete', old.id, old.text, old.note, old.book, old.author);
+                INSERT INTO highlights_fts (rowid, text, note, book, author)
+                VALUES (new.id, new.text, new.note, new.book, new.author);
+            END;
+        """)
+    except sqlite3.OperationalError as e:
+        print(f"Warning: Highlight store unavailable ({e}).")
+        conn.close()
+        return None
+    return conn
+
+
+def store_has_source(conn, source):
+    """Check whether the store holds any highlights from a source database."""
+    return conn.execute("SELECT 1 FROM highlights WHERE source = ? LIMIT 1", (source,)).fetchone() is not None
+
+
+def store_books(books, conn, source, full=False):
+    """Save each book's highlights to the store and pass the book through.
+
+    Highlights that disappeared from a re-extracted book are removed, and
+    unchanged rows are not rewritten, so the FTS index only sees changes.
+    When ``full`` says ``books`` is the source's whole library, books that
+    weren't seen are removed once the stream is used up.
+    """
+    seen = set()
+    for book in books:
+        seen.add(book.title)
+        with measure('store'):
+            existing = {
+                row['oid'] for row in conn.execute(
+                    "SELECT oid FROM highlights WHERE source = ? AND book = ?", (source, book.title)
+                )
+            }
+            current = {highlight.id for highlight in book.highlights}
+
+            conn.executemany(
+                "DELETE FROM highlights WHERE source = ? AND oid = ?",
+                ((source, oid) for oid in existing - current)
+            )
+            conn.executemany("""
+                INSERT INTO highlights (source, oid, book, author, text, note, page, epubcfi, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (source, oid) DO UPDATE SET
+                    book = excluded.book, author = excluded.author, text = excluded.text,
+                    note = excluded.note, page = excluded.page, epubcfi = excluded.epubcfi,
+                    timestamp = excluded.timestamp
+                WHERE (book, author, text, note, page, epubcfi, timestamp)
+                    IS NOT (excluded.book, excluded.author, excluded.text, excluded.note,
+                            excluded.page, excluded.epubcfi, excluded.timestamp)
+            """, (
+                (source, highlight.id, book.title, book.author, highlight.text,
+                 highlight.annotation, highlight.position, highlight.epubcfi, highlight.timestamp)
+                for highlight in book.highlights
+            ))
+        yield book
+
+    if full:
+        with measure('store'):
+            stored = {row['book'] for row in conn.execute(
+                "SELECT DISTINCT book FROM highlights WHERE source = ?", (source,)
+            )}
+            conn.executemany(
+                "DELETE FROM highlights WHERE source = ? AND book = ?",
+                ((source, title) for title in stored - seen)
+            )
+
+
+def search_highlights(conn, query, limit=20):
+    """Full-text search the highlight store, best matches first."""
+    sql = """
+        SELECT highlights.book, highlights.author, highlights.page, highlights.note,
+               highlights.timestamp, matches.snippet
+        FROM (
+            SELECT rowid, rank,
+                   snippet(highlights_fts, 0, '[', ']', '…', 24) as snippet
+            FROM highlights_fts
+            WHERE highlights_fts MATCH ?
+            ORDER BY rank
+            LIMIT ?
+        ) AS matches
+        JOIN highlights ON highlights.id = matches.rowid
+        ORDER BY matches.rank
+    """
+    try:
+        return conn.execute(sql, (query, limit)).fetchall()
+    except sqlite3.OperationalError:
+        # Not valid FTS5 query syntax; search for the words literally
+        words = ' '.join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+        return conn.execute(sql, (words, limit)).fetchall()
 
-            # Parse quotation JSON to get the highlighted text and position
-            import json as json_lib
-            try:
-                quotation_data = json_lib.loads(highlight['QuotationData'])
-                highlight_text = quotation_data.get('text', '')
-
-                # Extract position data (page, EPUB CFI)
-                begin_position = quotation_data.get('begin', '')
-                page_num = None
-                epubcfi = None
-
-                if begin_position:
-                    # Parse: "pbr:/word?page=243&offs=534#epubcfi(/6/96!/4/40/1:404)"
-                    import re
-                    page_match = re.search(r'page=(\d+)', begin_position)
-                    if page_match:
-                        page_num = int(page_match.group(1))
-
-                    epubcfi_match = re.search(r'epubcfi\(([^)]+)\)', begin_position)
-                    if epubcfi_match:
-                        epubcfi = f"epubcfi({epubcfi_match.group(1)})"
-
-            except (json_lib.JSONDecodeError, TypeError):
-                continue
 
-            if not highlight_text or highlight_text.strip() == '':
-                continue
+def search(args):
+    """Search synced highlights from the local store."""
+    if not STORE_FILE.exists():
+        print("No highlights stored yet. Run a sync first.")
+        sys.exit(EXIT_ERROR)
 
-            # Check if there's a note for this highlight
-            note_text = None
-            if note_tag_id:
-                cursor.execute("""
-                    SELECT Val FROM Tags
-                    WHERE ItemID = ? AND TagID = ?
-                """, (highlight['HighlightID'], note_tag_id))
-                note_result = cursor.fetchone()
-                if note_result:
-                    note_text = note_result['Val']
-
-            # Group by book title
-            if title not in books_dict:
-                books_dict[title] = {
-                    'title': title,
-                    'author': author,
-                    'highlights': []
-                }
-
-            books_dict[title]['highlights'].append({
-                'text': highlight_text.strip(),
-                'annotation': note_text,
-                'position': page_num,
-                'epubcfi': epubcfi,
-                'timestamp': highlight['TimeAlt'],
-                'type': 'highlight'
-            })
-
-        # Convert to list
-        books_with_highlights = list(books_dict.values())
+    conn = open_highlight_store()
+    if conn is None:
+        sys.exit(EXIT_ERROR)
 
+    try:
+        results = search_highlights(conn, args.query, args.limit)
+    finally:
         conn.close()
-        return books_with_highlights
 
-    except sqlite3.Error as e:
-        print(f"Database error: {e}")
-        import traceback
-        traceback.print_exc()
-        conn.close()
-        return []
+    if not results:
+        print(f"No highlights match: {args.query}")
+        return
+
+    print(f"Found {len(results)} highlight(s) matching: {args.query}\n")
+    for idx, row in enumerate(results, 1):
+        details = [row['author']] if row['author'] else []
+        if row['page']:
+            details.append(f"page {row['page']}")
+        timestamp = format_timestamp(row['timestamp'])
+        if timestamp:
+            details.append(timestamp)
+        print(f"{idx}. {row['book']} ({', '.join(details)})")
+        print(f"   {row['snippet']}")
+        if row['note']:
+            print(f"   Note: {row['note']}")
+        print()
 
 
 def sanitize_filename(filename):
@@ -332,189 +1810,1729 @@ def format_timestamp(timestamp):
     """Format Unix timestamp to readable date."""
     if timestamp:
         try:
-            return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
-        except (ValueError, OSError):
+            return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
+        except (ValueError, OSError, OverflowError):
             return None
     return None
 
 
-def create_obsidian_note(book, obsidian_path, calibre_info=None, calibre_library_path=None, highlights_folder_name='Book Highlights'):
-    """Create Obsidian markdown file for a book with highlights."""
-    highlights_folder = obsidian_path / highlights_folder_name
-    highlights_folder.mkdir(exist_ok=True)
+def content_hash(text):
+    """Hash note content for change detection."""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def compile_template(name, template, fields):
+    """Compile a note template into a function that renders a dict of values.
+
+    ``{field}`` is replaced by its value (``str.format`` syntax, so ``{{``
+    is a literal brace) and a line is left out when any field in it is
+    empty. Lines between ``{#field}`` and ``{/field}`` are kept only when
+    ``field`` is not empty. Returns ``(render, used_fields)`` and raises
+    ValueError for unknown fields or unbalanced sections.
+
+    The template is turned into the source of a function made of f-strings,
+    so rendering never re-parses it. Literal text and format specs are
+    passed in as constants and field names are checked against ``fields``,
+    so template text never becomes code.
+    """
+    formatter = string.Formatter()
+    chunks = []
+    used_fields = set()
+    sections = []
+
+    def check_field(field):
+        if field not in fields:
+            raise ValueError(f"{name} template: unknown field {{{field}}}")
+        used_fields.add(field)
+
+    for line in template.split('\n'):
+        section = TEMPLATE_SECTION_PATTERN.match(line)
+        if section:
+            kind, field = section.groups()
+            check_field(field)
+            if kind == '#':
+                sections.append(field)
+            elif not sections or sections.pop() != field:
+                raise ValueError(f"{name} template: {{/{field}}} does not close an open section")
+            continue
 
-    # Create safe filename
-    filename = sanitize_filename(f"{book['title']}.md")
-    filepath = highlights_folder / filename
+        try:
+            pieces = list(formatter.parse(line + '\n'))
+        except ValueError as e:
+            raise ValueError(f"{name} template: {e} in line {line!r}")
+        line_fields = []
+        for _, field, spec, conversion in pieces:
+            if field is None:
+                continue
+            check_field(field)
+            if conversion and conversion not in 'rsa':
+                raise ValueError(f"{name} template: unknown conversion !{conversion} in line {line!r}")
+            if spec and '{' in spec:
+                raise ValueError(f"{name} template: nested fields are not supported in line {line!r}")
+            line_fields.append(field)
+
+        # Consecutive lines kept under the same condition form one chunk
+        required = tuple(dict.fromkeys(sections + line_fields))
+        if chunks and chunks[-1][1] == required:
+            chunks[-1][0].extend(pieces)
+        else:
+            chunks.append((pieces, required))
+
+    if sections:
+        raise ValueError(f"{name} template: {{#{sections[-1]}}} is never closed")
+
+    constants = {}
+
+    def constant(value):
+        key = f"_{len(constants)}"
+        constants[key] = value
+        return key
+
+    expressions = []
+    for pieces, required in chunks:
+        parts = []
+        for literal, field, spec, conversion in pieces:
+            if literal:
+                parts.append(f"{{{constant(literal)}}}")
+            if field is not None:
+                conversion = f"!{conversion}" if conversion else ''
+                spec = f":{{{constant(spec)}}}" if spec else ''
+                parts.append(f"{{v[{field!r}]{conversion}{spec}}}")
+        expression = f"f\"{''.join(parts)}\""
+        if required:
+            condition = ' and '.join(f"v[{field!r}]" for field in required)
+            expression = f"({expression} if {condition} else '')"
+        expressions.append(expression)
+
+    source = f"def render(v):\n    return ''.join(({''.join(e + ', ' for e in expressions)}))\n"
+    exec(compile(source, f"<{name} template>", 'exec'), constants)
+    return constants['render'], used_fields
+
+
+def compile_note_templates(templates=None):
+    """Compile frontmatter, header and highlight templates once for a run.
+
+    ``templates`` maps template names to source text and falls back to
+    DEFAULT_TEMPLATES for any that are missing.
+    """
+    sources = dict(DEFAULT_TEMPLATES, **(templates or {}))
+    compiled = {'sources': sources}
+    for name, fields in (('frontmatter', BOOK_FIELDS), ('header', BOOK_FIELDS),
+                         ('highlight', BOOK_FIELDS | HIGHLIGHT_FIELDS)):
+        compiled[name], compiled[f"{name}_fields"] = compile_template(name, sources[name], fields)
+    return compiled
+
+
+def read_note_templates(templates_path):
+    """Read the templates in a folder (frontmatter.md, header.md, highlight.md).
+
+    Returns ``{name: source}`` for the files that exist; missing files fall
+    back to the default templates. A single trailing newline is ignored, as
+    editors usually add one.
+    """
+    templates = {}
+    for name in DEFAULT_TEMPLATES:
+        path = Path(templates_path).expanduser() / f"{name}.md"
+        if path.exists():
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            templates[name] = text[:-1] if text.endswith('\n') else text
+    return templates
 
-    # Build markdown content
-    content = []
 
-    # Frontmatter
-    content.append('---')
-    content.append(f"title: {book['title']}")
-    content.append(f"author: {book['author']}")
-    content.append(f"type: book-highlights")
-    content.append(f"sync_date: {datetime.now().strftime('%Y-%m-%d')}")
-    if calibre_info:
-        content.append(f"calibre_id: {calibre_info['id']}")
-    content.append('---')
-    content.append('')
+def load_note_templates(templates_path):
+    """Compile the templates in a folder; see read_note_templates."""
+    return compile_note_templates(read_note_templates(templates_path))
 
-    # Title and metadata
-    content.append(f"# {book['title']}")
-    content.append(f"**Author:** {book['author']}")
-    content.append(f"**Synced:** {datetime.now().strftime('%Y-%m-%d %H:%M')}")
 
-    # Add book-level links if Calibre info available
-    if calibre_info and calibre_library_path:
-        content.append('')
-        content.append('**Open in Calibre:**')
+NOTE_TEMPLATES = compile_note_templates()
+
+
+def quote_cfi(epubcfi):
+    """URL-encode an EPUB CFI like ``quote(epubcfi, safe='')``, but faster.
 
-        # calibre:// URL - use _ for current library
-        calibre_url = f"calibre://show-book/_/{calibre_info['id']}"
-        content.append(f"- [View in Calibre](<{calibre_url}>)")
+    CFIs use a handful of reserved characters, so replacing each of them
+    beats quote()'s per-character loop. Anything else goes to quote().
+    """
+    if CFI_CHARACTERS_PATTERN.fullmatch(epubcfi) is None:
+        from urllib.parse import quote
+        return quote(epubcfi, safe='')
+    for char, escaped in CFI_ESCAPES:
+        if char in epubcfi:
+            epubcfi = epubcfi.replace(char, escaped)
+    return epubcfi
+
+
+def book_values(book, calibre_info=None, calibre_library_path=None, sync_date=None, synced=None):
+    """Compute the book-level template values once per note."""
+    now = datetime.now()
+    values = {
+        'title': book.title,
+        'author': book.author,
+        'sync_date': sync_date if sync_date is not None else now.strftime('%Y-%m-%d'),
+        'synced': synced if synced is not None else now.strftime('%Y-%m-%d %H:%M'),
+        'calibre_id': calibre_info['id'] if calibre_info else None,
+        'calibre_url': None,
+        'calibre_view_url': None,
+        'epub_url': None
+    }
+
+    if calibre_info and calibre_library_path:
+        # calibre:// URLs use _ for the current library
+        values['calibre_url'] = f"calibre://show-book/_/{calibre_info['id']}"
+        values['calibre_view_url'] = f"calibre://view-book/_/{calibre_info['id']}/EPUB"
 
-        # file:// path to EPUB
         epub_path = calibre_library_path / calibre_info['path'] / f"{calibre_info['filename']}.epub"
-        if epub_path.exists():
-            file_url = epub_path.as_uri()
-            content.append(f"- [Open EPUB file](<{file_url}>)")
+        epub_exists = calibre_info.get('epub_exists')
+        if epub_exists is None:
+            epub_exists = epub_path.exists()
+        if epub_exists:
+            values['epub_url'] = epub_path.as_uri()
+
+    return values
+
+
+def highlight_location(highlight, added=None):
+    """Return "Page N | Added: <time>", or whichever part is known, or None."""
+    if added is None:
+        added = format_timestamp(highlight.timestamp)
+    if highlight.position and added:
+        return f"Page {highlight.position} | Added: {added}"
+    if highlight.position:
+        return f"Page {highlight.position}"
+    if added:
+        return f"Added: {added}"
+    return None
 
-    content.append('')
-    content.append('---')
-    content.append('')
 
-    # Highlights
-    content.append('## Highlights')
+def highlight_values(highlight, values, fields):
+    """Add one highlight's template values to a copy of the book values.
+
+    Only values named in ``fields`` that need formatting are computed.
+    """
+    added = location = None
+    if 'added' in fields or 'location' in fields:
+        added = format_timestamp(highlight.timestamp)
+        location = highlight_location(highlight, added)
+
+    link = None
+    if 'calibre_link' in fields:
+        link = values['calibre_view_url']
+        if link and highlight.epubcfi:
+            link = f"{link}?open_at={quote_cfi(highlight.epubcfi)}"
+
+    return {
+        **values,
+        'id': highlight.id,
+        'text': highlight.text,
+        'note': highlight.annotation,
+        'page': highlight.position,
+        'epubcfi': highlight.epubcfi,
+        'added': added,
+        'location': location,
+        'calibre_link': link
+    }
+
+
+def render_highlight_block(highlight, values, templates=None):
+    """Render one highlight with the highlight template, given book values."""
+    templates = templates or NOTE_TEMPLATES
+    return templates['highlight'](highlight_values(highlight, values, templates['highlight_fields']))
+
+
+def highlight_block_hash(highlight, calibre_info=None, calibre_library_path=None, templates=None):
+    """Hash everything a highlight block is rendered from."""
+    linked_id = calibre_info['id'] if calibre_info and calibre_library_path else None
+    parts = [highlight._asdict(), linked_id]
+    template = (templates or NOTE_TEMPLATES)['sources']['highlight']
+    if template != DEFAULT_TEMPLATES['highlight']:
+        parts.append(template)
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def mark_highlight_block(highlight, block, calibre_info=None, calibre_library_path=None, templates=None):
+    """Wrap a rendered highlight block in start and end ID markers."""
+    digest = highlight_block_hash(highlight, calibre_info, calibre_library_path, templates)
+    return (f"<!-- pocketbook-highlight:{highlight.id} {digest} -->\n"
+            f"{block}<!-- /pocketbook-highlight:{highlight.id} -->\n")
+
+
+def render_obsidian_note(book, calibre_info=None, calibre_library_path=None, sync_date=None, synced=None,
+                         markers=False, templates=None):
+    """Render the Obsidian markdown for a book from compiled templates.
+
+    Output depends only on the arguments; ``sync_date`` and ``synced``
+    default to the current time. With ``markers`` each highlight is
+    wrapped in ID markers so merge_obsidian_note() can patch it later.
+    ``templates`` comes from compile_note_templates() and defaults to
+    NOTE_TEMPLATES.
+    """
+    templates = templates or NOTE_TEMPLATES
+    values = book_values(book, calibre_info, calibre_library_path, sync_date, synced)
+    render_highlight = templates['highlight']
+    fields = templates['highlight_fields']
+
+    blocks = []
+    for highlight in book.highlights:
+        block = render_highlight(highlight_values(highlight, values, fields))
+        if markers:
+            block = mark_highlight_block(highlight, block, calibre_info, calibre_library_path, templates)
+        blocks.append(block)
+
+    return f"{templates['frontmatter'](values)}\n{templates['header'](values)}\n" + '\n---\n\n'.join(blocks)
+
+
+def render_logseq_page(book, calibre_info=None, calibre_library_path=None, sync_date=None, synced=None):
+    """Render a book as a Logseq outline page, one block per highlight.
+
+    Book metadata goes in page properties and the note, page and Calibre
+    link of a highlight are nested under it.
+    """
+    now = datetime.now()
+    if sync_date is None:
+        sync_date = now.strftime('%Y-%m-%d')
+    if synced is None:
+        synced = now.strftime('%Y-%m-%d %H:%M')
+
+    content = [
+        f"title:: {book.title}",
+        f"author:: [[{book.author}]]",
+        "type:: book-highlights",
+        f"sync-date:: {sync_date}",
+        f"synced:: {synced}"
+    ]
+    if calibre_info:
+        content.append(f"calibre-id:: {calibre_info['id']}")
+    if calibre_info and calibre_library_path:
+        content.append(f"calibre:: [View in Calibre](calibre://show-book/_/{calibre_info['id']})")
     content.append('')
 
-    for idx, highlight in enumerate(book['highlights'], 1):
-        # Main highlight text
-        if highlight['text']:
-            content.append(f"> {highlight['text']}")
-            content.append('')
+    for highlight in book.highlights:
+        text = highlight.text or ''
+        content.append(f"- > {text}".replace('\n', '\n  > '))
 
-        # Add annotation/note if exists
-        if highlight['annotation']:
-            content.append(f"**Note:** {highlight['annotation']}")
-            content.append('')
+        if highlight.annotation:
+            content.append(f"  - **Note:** {highlight.annotation}".replace('\n', '\n    '))
 
-        # Add metadata with page/link info
         metadata_parts = []
-
-        # Page number
-        if highlight.get('position'):
-            metadata_parts.append(f"Page {highlight['position']}")
-
-        # Timestamp
-        timestamp = format_timestamp(highlight['timestamp'])
+        if highlight.position:
+            metadata_parts.append(f"Page {highlight.position}")
+        timestamp = format_timestamp(highlight.timestamp)
         if timestamp:
             metadata_parts.append(f"Added: {timestamp}")
-
         if metadata_parts:
-            content.append(f"*{' | '.join(metadata_parts)}*")
-
-        # Add Calibre deep link
-        if calibre_info and calibre_library_path and highlight.get('epubcfi'):
-            # Use _ for current library, URL-encode the EPUB CFI
-            epubcfi_encoded = quote(highlight['epubcfi'], safe='')
-            calibre_url = f"calibre://view-book/_/{calibre_info['id']}/EPUB?open_at={epubcfi_encoded}"
-            content.append(f"[📖 Open in Calibre](<{calibre_url}>)")
-        elif calibre_info and calibre_library_path:
-            # Fallback if no EPUB CFI available
+            content.append(f"  - *{' | '.join(metadata_parts)}*")
+
+        if calibre_info and calibre_library_path:
             calibre_url = f"calibre://view-book/_/{calibre_info['id']}/EPUB"
-            content.append(f"[📖 Open in Calibre](<{calibre_url}>)")
+            if highlight.epubcfi:
+                calibre_url += f"?open_at={quote_cfi(highlight.epubcfi)}"
+            content.append(f"  - [📖 Open in Calibre]({calibre_url})")
+
+    content.append('')
+    return '\n'.join(content)
+
+
+# Per-book note layouts: the renderer, the folder notes go in (None for
+# the configured highlights folder), the volatile timestamp lines, and
+# whether merge-mode markers, note templates and chapter shards are supported
+NOTE_FORMATS = {
+    'obsidian': {'render': render_obsidian_note, 'folder': None,
+                 'sync_date': SYNC_DATE_PATTERN, 'synced': SYNCED_PATTERN, 'merge': True, 'templates': True,
+                 'shard': True},
+    'logseq': {'render': render_logseq_page, 'folder': 'pages',
+               'sync_date': LOGSEQ_SYNC_DATE_PATTERN, 'synced': LOGSEQ_SYNCED_PATTERN, 'merge': False,
+               'templates': False, 'shard': False}
+}
+
+# The note format written for each notes_app offered by setup.py
+NOTES_APP_FORMATS = {'Obsidian': 'obsidian', 'Logseq': 'logseq', 'Notion': 'obsidian', 'Other': 'obsidian'}
+
+
+def merge_obsidian_note(existing, book, calibre_info=None, calibre_library_path=None, templates=None):
+    """Patch new and changed highlights into an existing merge-mode note.
+
+    Only the ID markers of ``existing`` are parsed. Blocks whose hash
+    changed are re-rendered in place, new highlights are appended after the
+    last block, and everything outside the markers is kept as written.
+    Highlights deleted on the device keep their blocks. Returns the merged
+    text, or None if the note has no markers or nothing changed.
+    """
+    blocks = {match.group(1): match for match in HIGHLIGHT_BLOCK_PATTERN.finditer(existing)}
+    if not blocks:
+        return None
+
+    patches = []
+    appended = []
+    values = None
+    for highlight in book.highlights:
+        block = blocks.get(str(highlight.id))
+        if block is not None and block.group(2) == highlight_block_hash(highlight, calibre_info,
+                                                                        calibre_library_path, templates):
+            continue
+        if values is None:
+            values = book_values(book, calibre_info, calibre_library_path)
+        text = mark_highlight_block(
+            highlight, render_highlight_block(highlight, values, templates),
+            calibre_info, calibre_library_path, templates
+        )[:-1]
+        if block is None:
+            appended.append(f"\n\n---\n\n{text}")
+        else:
+            patches.append((block.start(), block.end(), text))
+
+    if not patches and not appended:
+        return None
+
+    last_end = max(block.end() for block in blocks.values())
+    if appended:
+        patches.append((last_end, last_end, ''.join(appended)))
+
+    pieces = []
+    position = 0
+    for start, end, text in sorted(patches, key=lambda patch: (patch[0], patch[1])):
+        pieces.append(existing[position:start])
+        pieces.append(text)
+        position = end
+    pieces.append(existing[position:])
+    merged = ''.join(pieces)
+
+    now = datetime.now()
+    merged = SYNC_DATE_PATTERN.sub(lambda m: f"sync_date: {now.strftime('%Y-%m-%d')}", merged, count=1)
+    merged = SYNCED_PATTERN.sub(lambda m: f"**Synced:** {now.strftime('%Y-%m-%d %H:%M')}", merged, count=1)
+    return merged
+
+
+def read_note(filepath):
+    """Return an existing note's text, or None if it is missing or unreadable."""
+    with measure('read_existing'):
+        if not filepath.exists():
+            return None
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                return f.read()
+        except (OSError, UnicodeDecodeError):
+            return None
+
+
+def write_note(filepath, render, layout, merge_book=None, calibre_info=None, calibre_library_path=None,
+               templates=None):
+    """Write one note file unless only its sync timestamps would change.
+
+    ``render(sync_date=None, synced=None)`` returns the note's text. With
+    ``merge_book`` an existing note with highlight markers is patched by
+    merge_obsidian_note() instead of being re-rendered. Returns whether the
+    file was written.
+    """
+    existing = read_note(filepath)
+
+    if merge_book is not None and existing is not None and HIGHLIGHT_BLOCK_PATTERN.search(existing):
+        with measure('render'):
+            merged = merge_obsidian_note(existing, merge_book, calibre_info, calibre_library_path, templates)
+        if merged is None:
+            return False
+        with measure('write'):
+            write_file_atomic(filepath, merged)
+        return True
+
+    # Re-render with the existing note's timestamps and compare hashes. A
+    # template without one of the timestamp lines renders the same whatever
+    # its value, so a missing line falls back to the current time
+    if existing is not None:
+        sync_date_match = layout['sync_date'].search(existing)
+        synced_match = layout['synced'].search(existing)
+        with measure('render'):
+            candidate = render(sync_date=sync_date_match.group(1) if sync_date_match else None,
+                               synced=synced_match.group(1) if synced_match else None)
+        if content_hash(candidate) == content_hash(existing):
+            return False
+
+    with measure('render'):
+        content = render()
+
+    with measure('write'):
+        write_file_atomic(filepath, content)
+
+    return True
+
+
+def chapter_sections(highlights):
+    """Split a book's highlights by chapter, in reading order.
+
+    Chapters are the spine items the highlights' CFIs point into. Returns
+    ``[(spine_step, highlights)]`` in spine order, with highlights without
+    a CFI last under None.
+    """
+    sections = {}
+    for highlight in sorted(highlights, key=reading_order_key):
+        cfi = parse_epubcfi(highlight.epubcfi)
+        sections.setdefault(cfi.spine if cfi else None, []).append(highlight)
+    return sorted(sections.items(), key=lambda section: (section[0] is None, section[0] or 0))
+
+
+def render_obsidian_index(book, sections, calibre_info=None, calibre_library_path=None, sync_date=None,
+                          synced=None, templates=None):
+    """Render the index note of a sharded book, linking its chapter notes.
+
+    ``sections`` is a list of ``(label, path)`` with paths relative to the
+    index note. Highlight counts are left out on purpose, so a new highlight
+    in an existing chapter doesn't rewrite the index.
+    """
+    templates = templates or NOTE_TEMPLATES
+    values = book_values(book, calibre_info, calibre_library_path, sync_date, synced)
+    links = '\n'.join(f"- [{label}](<{path}>)" for label, path in sections)
+    return f"{templates['frontmatter'](values)}\n{templates['header'](values)}\n{links}\n"
+
+
+def write_sharded_note(filepath, book, calibre_info, calibre_library_path, layout, merge, templates,
+                       render_kwargs):
+    """Write a book as one note per chapter in a book folder, plus an index note.
+
+    The index note takes the place of the book's single note, and chapter
+    notes go in a folder of the same name next to it. Each note is written
+    only when it changed, so a new highlight rewrites just its chapter.
+    Returns whether any note was written.
+    """
+    folder = filepath.parent / filepath.stem
+    folder.mkdir(exist_ok=True)
+
+    written = False
+    sections = []
+    for spine, highlights in chapter_sections(book.highlights):
+        if spine is None:
+            label = name = "Other Highlights"
+        else:
+            label, name = f"Section {spine // 2}", f"Section {spine // 2:03d}"
+        section_book = book._replace(title=f"{book.title} - {label}", highlights=highlights)
+        section_path = folder / sanitize_filename(f"{book.title} - {name}.md")
+        render = partial(layout['render'], section_book, calibre_info, calibre_library_path, **render_kwargs)
+        written |= write_note(section_path, render, layout, section_book if merge else None,
+                              calibre_info, calibre_library_path, templates)
+        sections.append((label, f"{folder.name}/{section_path.name}"))
+
+    render = partial(render_obsidian_index, book, sections, calibre_info, calibre_library_path,
+                     templates=render_kwargs.get('templates'))
+    written |= write_note(filepath, render, layout)
+    return written
+
+
+def remove_note(filepath):
+    """Remove a book's note and its chapter notes; return whether anything was removed."""
+    removed = False
+    folder = filepath.parent / filepath.stem
+    if folder.is_dir():
+        for path in folder.iterdir():
+            if path.name.startswith(f"{filepath.stem} - ") and path.suffix == '.md':
+                path.unlink()
+                removed = True
+        try:
+            folder.rmdir()
+        except OSError:
+            pass  # holds files of your own
+    if filepath.exists():
+        filepath.unlink()
+        removed = True
+    return removed
+
+
+def create_note(book, obsidian_path, calibre_info=None, calibre_library_path=None,
+                highlights_folder_name='Book Highlights', merge=False, note_format='obsidian', templates=None,
+                shard_min=None):
+    """Create the markdown file for a book with highlights in a NOTE_FORMATS layout.
+
+    Returns ``(filepath, written)``. An existing note is left untouched when
+    only its sync timestamps would change. With ``merge`` an existing note
+    with highlight markers is patched by merge_obsidian_note() instead of
+    being re-rendered; a note without markers is rendered in full once.
+    ``templates`` from compile_note_templates() apply to layouts that
+    support them. Books with at least ``shard_min`` highlights are split
+    into chapter notes by write_sharded_note(), unless a merge-mode note
+    for the book already exists, since that could hold your own edits.
+    """
+    layout = NOTE_FORMATS[note_format]
+    merge = merge and layout['merge']
+    render_kwargs = {}
+    if merge:
+        render_kwargs['markers'] = True
+    if templates and layout['templates']:
+        render_kwargs['templates'] = templates
+
+    highlights_folder = obsidian_path / highlights_folder_name
+    highlights_folder.mkdir(exist_ok=True)
+
+    # Create safe filename
+    filename = sanitize_filename(f"{book.title}.md")
+    filepath = highlights_folder / filename
+
+    # A book whose highlights were all deleted gets no note, as on a fresh
+    # sync; merge mode keeps deleted highlights, so it keeps the note
+    if not book.highlights:
+        return filepath, False if merge else remove_note(filepath)
+
+    if shard_min is not None and layout['shard'] and len(book.highlights) >= shard_min:
+        existing = read_note(filepath) if merge else None
+        if existing is None or not HIGHLIGHT_BLOCK_PATTERN.search(existing):
+            return filepath, write_sharded_note(filepath, book, calibre_info, calibre_library_path, layout,
+                                                merge, templates, render_kwargs)
+
+    render = partial(layout['render'], book, calibre_info, calibre_library_path, **render_kwargs)
+    written = write_note(filepath, render, layout, book if merge else None, calibre_info, calibre_library_path,
+                         templates)
+    return filepath, written
+
+
+def write_file_atomic(filepath, content):
+    """Write a file via a temp file and rename so readers never see it half-written."""
+    import tempfile
+    data = content.encode('utf-8')
+    fd, tmp_path = tempfile.mkstemp(dir=filepath.parent, prefix=f".{filepath.name}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, filepath)
+        add_metric('bytes_written', len(data))
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+async def run_pipeline(books, calibre_db_path, write, report, workers=DEFAULT_WRITE_WORKERS,
+                       buffer=PIPELINE_BUFFER_BOOKS):
+    """Extract, match and write books as three overlapping stages.
+
+    ``books`` is advanced on its own thread, since SQLite connections belong
+    to the thread that opened them. Calibre's index is loaded and matched
+    against on a second thread, and ``write(book, calibre_info)`` runs on
+    ``workers`` threads, returning ``(filepath, written)``. Each note's
+    outcome is passed to ``report(book, calibre_info, filepath, written,
+    error)`` in input order; a failed note reports its exception instead of
+    aborting the run.
+
+    Bounded queues between the stages let each run at most ``buffer``
+    books ahead of the next. When cancelled (Ctrl-C), no new note is
+    started and notes already being written finish; each is written
+    atomically, so none is left half-written.
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    loop = asyncio.get_running_loop()
+    workers = max(1, workers)
+    done = object()
+    extracted = asyncio.Queue(maxsize=buffer)
+    matched = asyncio.Queue(maxsize=buffer)
+    writing = asyncio.Queue(maxsize=workers)
+    slots = asyncio.Semaphore(workers)
+
+    extract_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='extract')
+    calibre_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='calibre')
+    write_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='write')
+
+    async def extract():
+        while True:
+            book = await loop.run_in_executor(extract_executor, next, books, done)
+            await extracted.put(book)
+            if book is done:
+                return
+
+    async def match():
+        # Loading the index overlaps with snapshotting and reading books.db
+        index = await loop.run_in_executor(calibre_executor, load_calibre_index, calibre_db_path)
+
+        def match_book(book):
+            with measure('calibre_match'):
+                return match_calibre_index(index, book.title, book.author)
+
+        while True:
+            book = await extracted.get()
+            if book is done:
+                await matched.put(done)
+                return
+            calibre_info = None
+            if index is not None:
+                calibre_info = await loop.run_in_executor(calibre_executor, match_book, book)
+            await matched.put((book, calibre_info))
+
+    async def start_writes():
+        while True:
+            item = await matched.get()
+            if item is done:
+                await writing.put(done)
+                return
+            await slots.acquire()
+            future = loop.run_in_executor(write_executor, write, *item)
+            future.add_done_callback(lambda _: slots.release())
+            await writing.put((item, future))
+
+    async def collect():
+        while True:
+            entry = await writing.get()
+            if entry is done:
+                return
+            (book, calibre_info), future = entry
+            try:
+                filepath, written = await future
+            except Exception as e:
+                report(book, calibre_info, None, False, e)
+            else:
+                report(book, calibre_info, filepath, written, None)
+
+    tasks = [asyncio.ensure_future(stage()) for stage in (extract, match, start_writes, collect)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Close the book stream on its own thread so an interrupted export
+        # removes its temp file and books.db is closed where it was opened
+        close = getattr(books, 'close', None)
+        if close is not None:
+            await loop.run_in_executor(extract_executor, close)
+        for executor in (extract_executor, calibre_executor, write_executor):
+            executor.shutdown(wait=True)
+
+
+def export_row(book, highlight):
+    """Flatten one highlight into an EXPORT_FIELDS row."""
+    return {
+        'book': book.title,
+        'author': book.author,
+        'id': highlight.id,
+        'text': highlight.text,
+        'note': highlight.annotation,
+        'page': highlight.position,
+        'epubcfi': highlight.epubcfi,
+        'timestamp': highlight.timestamp,
+        'type': highlight.type
+    }
+
+
+@contextmanager
+def open_export(path):
+    """Open a temp file for an export that replaces ``path`` only on success."""
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def export_jsonl(books, path):
+    """Write each book's highlights as JSON Lines and pass the book through."""
+    with open_export(path) as f:
+        for book in books:
+            with measure('export'):
+                for highlight in book.highlights:
+                    f.write(json.dumps(export_row(book, highlight), ensure_ascii=False) + '\n')
+            yield book
+
+
+def export_csv(books, path):
+    """Write each book's highlights as CSV rows and pass the book through."""
+    import csv
+    with open_export(path) as f:
+        writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        for book in books:
+            with measure('export'):
+                writer.writerows(export_row(book, highlight) for highlight in book.highlights)
+            yield book
+
+
+# Streaming exports for --export FORMAT PATH; each wraps the book stream
+EXPORT_FORMATS = {'jsonl': export_jsonl, 'csv': export_csv}
+
+
+class NotionError(Exception):
+    """A Notion API request failed. ``status`` is None for network errors."""
+
+    def __init__(self, message, status=None, code=None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+
+class TokenBucket:
+    """A thread-safe token bucket allowing ``rate`` requests a second on average.
+
+    Up to ``burst`` unused tokens are saved up, so short bursts go out at once.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """Add the tokens earned since the last call."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Wait for a token and take it."""
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold every caller back for ``seconds``, as a 429 response asks."""
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+def parse_retry_after(value):
+    """Return a Retry-After header's delay in seconds, or None."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
 
-        content.append('')
 
-        # Add separator between highlights
-        if idx < len(book['highlights']):
-            content.append('---')
-            content.append('')
+class NotionClient:
+    """A minimal client for the Notion API endpoints the sync uses.
+
+    Requests reuse a pool of keep-alive connections, one per concurrent
+    request, run at most ``concurrency`` at a time, and are paced by a
+    shared token bucket. Rate-limited (429) and server error responses and
+    dropped connections are retried with exponential backoff, honouring
+    Retry-After; requests that must not be applied twice are checked
+    first. ``api_url`` may be an http:// URL, e.g. a local stand-in server
+    for testing.
+    """
+
+    def __init__(self, token, api_url=NOTION_API_URL, concurrency=NOTION_CONCURRENCY, rate=NOTION_RATE,
+                 burst=NOTION_BURST, max_retries=NOTION_MAX_RETRIES, backoff=NOTION_BACKOFF,
+                 timeout=NOTION_TIMEOUT):
+        import http.client
+        import queue
+        from urllib.parse import urlsplit
+
+        url = urlsplit(api_url)
+        if url.scheme not in ('https', 'http') or not url.hostname:
+            raise ValueError(f"not an http(s) URL: {api_url}")
+        if url.scheme == 'https':
+            self.connection_class = http.client.HTTPSConnection
+        else:
+            self.connection_class = http.client.HTTPConnection
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path.rstrip('/')
+        self.headers = {
+            'Authorization': f"Bearer {token}",
+            'Notion-Version': NOTION_VERSION,
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        }
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = threading.BoundedSemaphore(max(1, concurrency))
+        self.connections = queue.LifoQueue()
+
+    def request(self, method, path, body=None, retry_unsure=True):
+        """Send a request and return its decoded JSON response.
+
+        With ``retry_unsure`` false only rate-limited (429) responses are
+        retried. After a dropped connection or a server error the request
+        may already have been applied, so the NotionError is raised for the
+        caller to check first; see request_once.
+
+        Raises NotionError for an error response, or when retries run out.
+        """
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        for attempt in range(self.max_retries + 1):
+            status, payload, retry_after, error = self.send(method, path, data)
+            if status is not None and 200 <= status < 300:
+                return json.loads(payload) if payload else {}
+            if status is not None and status not in NOTION_RETRY_STATUSES:
+                break
+            if status != 429 and not retry_unsure:
+                break
+            if attempt == self.max_retries:
+                break
+            self.wait(attempt, retry_after, rate_limited=status == 429)
+
+        if status is None:
+            raise NotionError(f"{method} {path} failed: {error}")
+        try:
+            details = json.loads(payload)
+        except ValueError:
+            details = {}
+        message = details.get('message') or payload[:200].decode('utf-8', 'replace')
+        raise NotionError(f"{method} {path} failed with HTTP {status}: {message}", status, details.get('code'))
+
+    def request_once(self, method, path, body, find_applied):
+        """Send a request that must not be applied twice, e.g. a POST or an append.
+
+        After a failure that leaves it unclear whether Notion applied the
+        request, ``find_applied()`` is asked for the response it would have
+        given; it returns None if the request did not go through, and the
+        request is sent again.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.request(method, path, body, retry_unsure=False)
+            except NotionError as e:
+                if not notion_unsure(e) or attempt == self.max_retries:
+                    raise
+            self.wait(attempt)
+            response = find_applied()
+            if response is not None:
+                return response
+
+    def wait(self, attempt, retry_after=None, rate_limited=False):
+        """Sleep before retrying, backing off exponentially unless told how long to wait."""
+        import random
+
+        delay = retry_after
+        if delay is None:
+            delay = min(NOTION_BACKOFF_MAX, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+        if rate_limited:
+            self.bucket.pause(delay)
+        add_metric('notion_retries')
+        time.sleep(delay)
+
+    def send(self, method, path, data):
+        """Send one request on a pooled connection.
+
+        Returns ``(status, body, retry_after, error)``; ``status`` is None
+        when the connection failed, with the exception as ``error``.
+        """
+        import http.client
+        import queue
 
-    # Write file
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(content))
+        self.bucket.acquire()
+        with self.slots:
+            try:
+                conn = self.connections.get_nowait()
+            except queue.Empty:
+                conn = self.connection_class(self.host, self.port, timeout=self.timeout)
+            try:
+                with measure('notion'):
+                    conn.request(method, self.base_path + path, body=data, headers=self.headers)
+                    response = conn.getresponse()
+                    payload = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                # A closed connection reconnects on its next request
+                conn.close()
+                return None, None, None, e
+            finally:
+                self.connections.put(conn)
+            add_metric('notion_requests')
+            if data is not None:
+                add_metric('bytes_written', len(data))
+            return response.status, payload, parse_retry_after(response.getheader('Retry-After')), None
+
+    def close(self):
+        """Close every pooled connection."""
+        import queue
+
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class NotionMap:
+    """The Notion page of each synced book and the block of each highlight.
+
+    Kept in a small SQLite database next to the config file so reruns only
+    send new and changed highlights. Shared by the writer threads, so every
+    call holds a lock.
+    """
+
+    def __init__(self, path=NOTION_MAP_FILE):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                parent TEXT NOT NULL,
+                title TEXT NOT NULL,
+                page_id TEXT NOT NULL,
+                PRIMARY KEY (parent, title)
+            );
+            CREATE TABLE IF NOT EXISTS blocks (
+                page_id TEXT NOT NULL,
+                highlight TEXT NOT NULL,
+                block_id TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                PRIMARY KEY (page_id, highlight)
+            );
+        """)
+
+    def page(self, parent_id, title):
+        """Return the page ID for a book, or None if it has no page yet."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT page_id FROM pages WHERE parent = ? AND title = ?", (parent_id, title)
+            ).fetchone()
+        return row[0] if row else None
+
+    def blocks(self, page_id):
+        """Return ``{highlight_id: (block_id, hash)}`` for a page."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT highlight, block_id, hash FROM blocks WHERE page_id = ?", (page_id,)
+            ).fetchall()
+        return {highlight: (block_id, digest) for highlight, block_id, digest in rows}
+
+    def save_page(self, parent_id, title, page_id):
+        """Record the page created for a book."""
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO pages (parent, title, page_id) VALUES (?, ?, ?)",
+                              (parent_id, title, page_id))
+
+    def save_blocks(self, page_id, rows):
+        """Record ``(highlight_id, block_id, hash)`` rows as soon as Notion has them."""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO blocks (page_id, highlight, block_id, hash) VALUES (?, ?, ?, ?)",
+                ((page_id, highlight, block_id, digest) for highlight, block_id, digest in rows)
+            )
+
+    def forget_page(self, parent_id, title, page_id):
+        """Drop a book's page and blocks, e.g. after the page was deleted in Notion."""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM pages WHERE parent = ? AND title = ?", (parent_id, title))
+            self.conn.execute("DELETE FROM blocks WHERE page_id = ?", (page_id,))
+
+    def close(self):
+        """Close the map database."""
+        self.conn.close()
+
+
+def notion_page_id(value):
+    """Return the dashed page ID from a Notion page ID or page URL."""
+    path = value.strip().split('?')[0].split('#')[0].rstrip('/')
+    match = NOTION_ID_PATTERN.search(path.replace('-', ''))
+    if match is None:
+        raise ValueError(f"not a Notion page ID or URL: {value}")
+    digits = match.group(1).lower()
+    return f"{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}"
+
+
+def notion_missing(error):
+    """Whether a NotionError means the page or block was deleted in Notion."""
+    return error.status == 404 or (error.status == 400 and 'archived' in str(error))
+
+
+def notion_unsure(error):
+    """Whether a failed request may still have been applied by Notion."""
+    return error.status is None or error.status >= 500
+
+
+def notion_children(client, block_id):
+    """Return every child block of a page, following Notion's pagination."""
+    from urllib.parse import urlencode
+
+    children = []
+    query = {'page_size': 100}
+    while True:
+        response = client.request('GET', f"/blocks/{block_id}/children?{urlencode(query)}")
+        children.extend(response.get('results', []))
+        if not response.get('has_more') or not response.get('next_cursor'):
+            return children
+        query['start_cursor'] = response['next_cursor']
+
+
+def notion_block_text(block):
+    """Return the text of a block, as sent to Notion or as listed back."""
+    content = block.get(block.get('type'), {})
+    return ''.join(item.get('text', {}).get('content', '') for item in content.get('rich_text', []))
+
+
+def notion_rich_text(text, **annotations):
+    """Split text into Notion text objects within the per-object length limit."""
+    rich_text = []
+    for start in range(0, len(text), NOTION_TEXT_LIMIT):
+        item = {'type': 'text', 'text': {'content': text[start:start + NOTION_TEXT_LIMIT]}}
+        if annotations:
+            item['annotations'] = annotations
+        rich_text.append(item)
+    return rich_text
+
+
+def notion_highlight_block(highlight):
+    """Render a highlight as one Notion quote block with its note and location.
+
+    Calibre links are left out; Notion only accepts web links.
+    """
+    rich_text = notion_rich_text(highlight.text or '')
+    if highlight.annotation:
+        rich_text += notion_rich_text('\n\nNote: ', bold=True) + notion_rich_text(highlight.annotation)
+    location = highlight_location(highlight)
+    if location:
+        rich_text += notion_rich_text(f"\n{location}", italic=True, color='gray')
+    # A block holds at most 100 text objects, about 200,000 characters
+    return {'object': 'block', 'type': 'quote', 'quote': {'rich_text': rich_text[:NOTION_RICH_TEXT_LIMIT]}}
+
+
+def notion_batches(items):
+    """Group ``(highlight_id, block, hash)`` items into appends within Notion's limits."""
+    batch = []
+    size = 0
+    for item in items:
+        item_size = len(json.dumps(item[1]))
+        if batch and (len(batch) >= NOTION_BATCH_BLOCKS or size + item_size > NOTION_BATCH_BYTES):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(item)
+        size += item_size
+    if batch:
+        yield batch
+
+
+def create_notion_page(client, parent_id, book):
+    """Create an empty page for a book under ``parent_id`` and return its ID."""
+    children = [
+        {'object': 'block', 'type': 'paragraph',
+         'paragraph': {'rich_text': notion_rich_text('Author: ', bold=True) + notion_rich_text(book.author)}},
+        {'object': 'block', 'type': 'divider', 'divider': {}}
+    ]
 
-    return filepath
+    def find_applied():
+        # The newest page with this title is the one an unanswered POST made
+        for block in reversed(notion_children(client, parent_id)):
+            if block.get('type') == 'child_page' and block['child_page'].get('title') == book.title:
+                return {'id': block['id']}
+        return None
 
+    page = client.request_once('POST', '/pages', {
+        'parent': {'page_id': parent_id},
+        'properties': {'title': {'title': notion_rich_text(book.title)}},
+        'children': children
+    }, find_applied)
+    return page['id']
+
+
+def append_notion_blocks(client, notion_map, page_id, blocks):
+    """Append blocks to a page and return the blocks Notion created.
+
+    If an append goes unanswered, the page's last blocks are checked before
+    it is sent again: when they match these blocks and aren't in the map,
+    Notion applied it and they are used instead of a second copy.
+    """
+    def find_applied():
+        known = {block_id for block_id, _ in notion_map.blocks(page_id).values()}
+        tail = notion_children(client, page_id)[-len(blocks):]
+        if len(tail) == len(blocks) and all(
+            listed['id'] not in known and listed.get('type') == block['type']
+            and notion_block_text(listed) == notion_block_text(block)
+            for listed, block in zip(tail, blocks)
+        ):
+            return {'results': tail}
+        return None
 
-def main():
+    response = client.request_once('PATCH', f"/blocks/{page_id}/children", {'children': blocks}, find_applied)
+    return response.get('results', [])
+
+
+def update_notion_page(client, notion_map, page_id, items):
+    """Send a page's changed and new highlight blocks; return whether anything was sent.
+
+    Changed blocks are updated in place and new ones appended in batches.
+    A block deleted in Notion is appended again.
+    """
+    known = notion_map.blocks(page_id)
+    new = []
+    sent = False
+    for highlight_id, block, digest in items:
+        saved = known.get(highlight_id)
+        if saved is None:
+            new.append((highlight_id, block, digest))
+            continue
+        block_id, saved_digest = saved
+        if saved_digest == digest:
+            continue
+        try:
+            client.request('PATCH', f"/blocks/{block_id}", {'quote': block['quote']})
+        except NotionError as e:
+            if not notion_missing(e):
+                raise
+            new.append((highlight_id, block, digest))
+            continue
+        notion_map.save_blocks(page_id, [(highlight_id, block_id, digest)])
+        sent = True
+
+    for batch in notion_batches(new):
+        results = append_notion_blocks(client, notion_map, page_id, [block for _, block, _ in batch])
+        if len(results) != len(batch):
+            raise NotionError(f"Notion returned {len(results)} blocks for {len(batch)} highlights")
+        notion_map.save_blocks(page_id, [
+            (highlight_id, result['id'], digest) for (highlight_id, _, digest), result in zip(batch, results)
+        ])
+        sent = True
+    return sent
+
+
+def write_notion_page(client, notion_map, parent_id, book):
+    """Create or update a book's Notion page, sending only what changed.
+
+    Returns ``(title, written)``. Highlights deleted on the device keep
+    their blocks, as in merge mode, so a book left without highlights is
+    not touched. A page deleted in Notion is created again.
+    """
+    if not book.highlights:
+        return book.title, False
+
+    with measure('render'):
+        items = []
+        for highlight in book.highlights:
+            block = notion_highlight_block(highlight)
+            digest = hashlib.sha1(json.dumps(block, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+            items.append((str(highlight.id), block, digest))
+
+    page_id = notion_map.page(parent_id, book.title)
+    if page_id is not None:
+        try:
+            return book.title, update_notion_page(client, notion_map, page_id, items)
+        except NotionError as e:
+            if not notion_missing(e):
+                raise
+            notion_map.forget_page(parent_id, book.title, page_id)
+
+    page_id = create_notion_page(client, parent_id, book)
+    notion_map.save_page(parent_id, book.title, page_id)
+    update_notion_page(client, notion_map, page_id, items)
+    return book.title, True
+
+
+def parse_args(argv=None):
+    """Parse command-line options."""
+    parser = argparse.ArgumentParser(description="Sync Pocketbook highlights to Obsidian.")
+    parser.add_argument('--device', default=os.environ.get(ENV_DEVICE), metavar='PATH',
+                        help=f"Pocketbook mount path (default: ${ENV_DEVICE}, the config file or auto-detect)")
+    parser.add_argument('--vault', default=os.environ.get(ENV_VAULT), metavar='PATH',
+                        help=f"notes vault or graph path (default: ${ENV_VAULT} or the config file)")
+    parser.add_argument('--calibre', default=os.environ.get(ENV_CALIBRE), metavar='PATH',
+                        help=f"Calibre library path (default: ${ENV_CALIBRE} or the config file)")
+    parser.add_argument('--source', action='append', metavar='PATH',
+                        help="sync from this Pocketbook mount path or books.db file instead of the device; "
+                             "repeat to merge several readers and backups")
+    parser.add_argument('--no-calibre', action='store_true',
+                        help="skip Calibre matching and backlinks")
+    parser.add_argument('--batch', action='store_true', default=os.environ.get(ENV_BATCH, '').strip().lower() in ENV_TRUE_VALUES,
+                        help=f"never prompt; exit with a status code when something is missing "
+                             f"(also set by ${ENV_BATCH}=1)")
+    parser.add_argument('--full-resync', action='store_true',
+                        help="ignore the saved watermark and re-render every book")
+    parser.add_argument('--no-snapshot', action='store_true',
+                        help="read books.db directly on the device instead of a local copy")
+    parser.add_argument('--index-snapshot', action='store_true',
+                        help="build indexes on the local copy of books.db to speed up extraction")
+    parser.add_argument('--jobs', type=int, default=None, metavar='N',
+                        help=f"number of notes to write concurrently (default: {DEFAULT_WRITE_WORKERS})")
+    parser.add_argument('--merge', action='store_true',
+                        help="patch new and changed highlights into existing notes, keeping your edits")
+    parser.add_argument('--reading-order', action='store_true',
+                        help="order highlights by their position in the book instead of when they were made")
+    parser.add_argument('--shard-chapters', action='store_true',
+                        help=f"split books with many highlights (default: {SHARD_MIN_HIGHLIGHTS}) "
+                             "into one note per chapter")
+    parser.add_argument('--export', nargs=2, action='append', default=[], metavar=('FORMAT', 'PATH'),
+                        help=f"also export every highlight to PATH in the same pass "
+                             f"({', '.join(EXPORT_FORMATS)}); may be repeated")
+    parser.add_argument('--metrics', action='store_true',
+                        help="print time per stage, SQL queries, rows read and bytes written")
+    parser.add_argument('--metrics-json', metavar='PATH',
+                        help="write the per-stage metrics to a JSON file")
+    parser.add_argument('--profile', nargs='?', const=True, default=None, metavar='PATH',
+                        help="run under cProfile and print the hottest functions "
+                             "(or save the profile to PATH)")
+
+    subparsers = parser.add_subparsers(dest='command')
+    search_parser = subparsers.add_parser('search', help="full-text search synced highlights")
+    search_parser.add_argument('query', help="words or FTS5 query to search for")
+    search_parser.add_argument('--limit', type=int, default=20, help="maximum results (default: 20)")
+    watch_parser = subparsers.add_parser('watch', help="keep running and sync whenever a Pocketbook is mounted")
+    watch_parser.add_argument('--interval', type=float, default=DEFAULT_WATCH_INTERVAL, metavar='SECONDS',
+                              help=f"seconds between checks for a mounted device (default: {DEFAULT_WATCH_INTERVAL:g})")
+
+    args = parser.parse_args(argv)
+    for export_format, export_path in args.export:
+        if export_format not in EXPORT_FORMATS:
+            parser.error(f"unknown export format {export_format!r} (choose from {', '.join(EXPORT_FORMATS)})")
+    return args
+
+
+def main(argv=None):
     """Main sync function."""
+    args = parse_args(argv)
+
+    if args.command == 'search':
+        search(args)
+        return
+
+    try:
+        config = load_config()
+    except (ValueError, OSError) as e:
+        print(f"Error: Could not read config file {CONFIG_FILE}: {e}")
+        sys.exit(EXIT_CONFIG)
+
+    if args.command == 'watch':
+        watch(args, config)
+        return
+
+    reset_metrics()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    start = time.perf_counter()
+    try:
+        if profiler:
+            profiler.runcall(sync, args, config)
+        else:
+            sync(args, config)
+    finally:
+        summary = metrics_summary(time.perf_counter() - start)
+
+        if args.metrics:
+            print_metrics(summary)
+
+        if args.metrics_json:
+            with open(args.metrics_json, 'w') as f:
+                json.dump(summary, f, indent=2)
+            print(f"\nMetrics written to: {args.metrics_json}")
+
+        if profiler:
+            if args.profile is True:
+                import pstats
+                print()
+                pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+            else:
+                profiler.dump_stats(args.profile)
+                print(f"\nProfile written to: {args.profile}")
+
+
+def get_notion_settings(config):
+    """Return the Notion sink's settings, or None to write Markdown files.
+
+    Notion pages are created through the API when the notes app is Notion
+    and both a token (``$POCKETBOOK_SYNC_NOTION_TOKEN`` or "notion_token")
+    and "notion_parent_page" are configured. Exits with EXIT_CONFIG when
+    only one of them is.
+    """
+    if config.get('notes_app') != 'Notion':
+        return None
+    token = os.environ.get(ENV_NOTION_TOKEN) or config.get('notion_token')
+    parent = config.get('notion_parent_page')
+    if not token and not parent:
+        return None
+
+    if not token or not parent:
+        missing = 'notion_parent_page' if token else f"notion_token (or ${ENV_NOTION_TOKEN})"
+        print(f"\nError: Notion is configured without {missing}.")
+        print("Set both to sync to Notion, or neither to write Markdown files for importing.")
+        sys.exit(EXIT_CONFIG)
+    try:
+        parent_id = notion_page_id(parent)
+    except ValueError as e:
+        print(f"\nError: Invalid notion_parent_page: {e}")
+        sys.exit(EXIT_CONFIG)
+
+    return {
+        'token': token,
+        'parent_id': parent_id,
+        'api_url': config.get('notion_api_url', NOTION_API_URL),
+        'concurrency': config.get('notion_concurrency', NOTION_CONCURRENCY)
+    }
+
+
+def sync(args, config):
+    """Run one sync with parsed command-line options and the loaded config."""
     print("=" * 60)
     print("Pocketbook to Obsidian Highlights Sync")
     print("=" * 60)
     print()
 
-    # Load config for highlights folder name
-    config = load_config()
-    highlights_folder_name = config.get('highlights_folder', 'Book Highlights')
-
-    # Get paths
-    pocketbook_path = get_pocketbook_path()
-    obsidian_path = get_obsidian_path()
-    calibre_library_path = get_calibre_library_path()
+    note_format = NOTES_APP_FORMATS.get(config.get('notes_app'), 'obsidian')
+    highlights_folder_name = NOTE_FORMATS[note_format]['folder'] or config.get('highlights_folder', 'Book Highlights')
+    notion = get_notion_settings(config)
 
-    # Find database
-    db_path = pocketbook_path / 'system' / 'config' / 'books.db'
-
-    if not db_path.exists():
+    # Get paths: the device, or every configured source
+    sources = args.source or config.get('sources')
+    if sources:
+        sources = resolve_sources(sources)
+    else:
+        pocketbook_path = get_pocketbook_path(config, args.device, args.batch)
+        sources = [(pocketbook_path / 'system' / 'config' / 'books.db', None)]
+    # Notion pages have no Calibre links, since Notion only accepts web links
+    calibre_library_path = None
+    if notion:
+        notes_path = f"notion:{notion['parent_id']}"
+    else:
+        obsidian_path = get_obsidian_path(config, args.vault, args.batch)
+        notes_path = str(obsidian_path / highlights_folder_name)
+        if not args.no_calibre:
+            calibre_library_path = get_calibre_library_path(config, args.calibre, args.batch)
+
+    # Several sources are always read in full and merged: a book that
+    # changed on one reader needs its highlights from every reader
+    merged = len(sources) > 1
+    db_path = sources[0][0]
+    if merged:
+        source_id = [str(source_db) for source_db, _ in sources]
+    elif not db_path.exists():
         print(f"\nError: Database not found at {db_path}")
         print("Please check that your Pocketbook is properly connected.")
-        sys.exit(1)
-
-    print(f"\nExtracting highlights from: {db_path}")
-
-    # Extract highlights
-    books_with_highlights = extract_highlights(db_path)
-
-    if not books_with_highlights:
-        print("\nNo highlights found in the database.")
-        print("Make sure you have highlighted text in some books on your Pocketbook.")
-        sys.exit(0)
+        sys.exit(EXIT_NO_DEVICE)
+    else:
+        source_id = str(db_path)
 
-    print(f"\nFound {len(books_with_highlights)} book(s) with highlights:")
-    for book in books_with_highlights:
-        print(f"  - {book['title']} by {book['author']} ({len(book['highlights'])} highlights)")
+    # Recorded with the state so watch mode can skip an unchanged database
+    fingerprint = None if merged else database_fingerprint(db_path)
 
-    # Create Obsidian notes
-    print(f"\nCreating notes in: {obsidian_path / highlights_folder_name}")
+    merge = args.merge or config.get('merge_notes', False)
+    reading_order = args.reading_order or config.get('reading_order', False)
+    shard_min = None
+    if args.shard_chapters or config.get('shard_chapters', False):
+        shard_min = config.get('shard_min_highlights', SHARD_MIN_HIGHLIGHTS)
 
+    templates = None
+    template_sources = None
+    if config.get('templates_path'):
+        try:
+            template_sources = read_note_templates(config['templates_path'])
+            templates = compile_note_templates(template_sources)
+        except (OSError, UnicodeDecodeError, ValueError) as e:
+            print(f"\nError: Could not load note templates from {config['templates_path']}: {e}")
+            sys.exit(EXIT_CONFIG)
+    render = render_fingerprint(note_format, template_sources, merge, shard_min, reading_order,
+                                calibre_library_path)
+
+    # Incremental sync only applies to the same database, vault and note
+    # settings
+    state = load_state()
+    same_target = state.get('db_path') == source_id and state.get('notes_path') == notes_path
+    # Books synced here before; after a full extraction, the ones not seen
+    # again have lost every highlight
+    synced_titles = set(state.get('books', {})) if same_target else set()
+    if args.full_resync or not same_target or state.get('render') != render:
+        state = {}
+    since = None if merged else state.get('watermark')
+    book_states = state.get('books', {})
+
+    index = args.index_snapshot or config.get('index_snapshot', False)
+    store = open_highlight_store()
+
+    # Exports cover the whole library, so they need a full extraction
+    exports = [(export_format, Path(export_path).expanduser()) for export_format, export_path in args.export]
+    if exports:
+        since = None
+
+    new_book_states = {}
+    if merged:
+        print(f"\nExtracting highlights from {len(sources)} sources:")
+        for source_db, _ in sources:
+            print(f"  - {source_db}")
+        watermark = None
+        highlight_counts = None
+        books = extract_sources(sources, store, snapshot=not args.no_snapshot, index=index)
+    else:
+        # Copy the device database locally so it is read once, sequentially
+        source_path = db_path
+        if not args.no_snapshot:
+            print(f"\nSnapshotting device database: {db_path}")
+            with measure('snapshot'):
+                source_path = snapshot_database(db_path, index=index)
+            print("Snapshot ready. The device can be ejected.")
+
+        watermark = get_highlight_watermark(source_path, immutable=not args.no_snapshot)
+        highlight_counts = get_highlight_counts(source_path, immutable=not args.no_snapshot)
+
+        # Deleting a highlight leaves the watermark alone, so books whose
+        # highlight count changed are re-extracted too. A state saved
+        # before counts were kept can't tell, so it gets a full extraction.
+        if since:
+            if 'highlight_counts' not in state:
+                since = None
+            else:
+                changed = changed_highlight_counts(state['highlight_counts'], highlight_counts)
+                # A book with no highlights left returns no rows, so only a
+                # full extraction notices it is gone
+                if (len(changed) > MAX_CHANGED_PARENTS
+                        or any(str(parent) not in highlight_counts for parent in changed)):
+                    since = None
+                elif changed:
+                    since = dict(since, parents=changed)
+
+        # Fill a new highlight store with a full extraction; notes whose
+        # highlights are unchanged are still skipped by their saved hashes
+        if store is not None and since and not store_has_source(store, str(db_path)):
+            since = None
+
+        if since:
+            print(f"\nExtracting new highlights from: {source_path}")
+        else:
+            print(f"\nExtracting highlights from: {source_path}")
+
+        # Stream books from extraction through Calibre matching into notes, so
+        # only one book is held in memory and matching overlaps with writing.
+        # books.db is sorted by title first, so the first note still waits for
+        # about half of a full extraction
+        books = iter_books(source_path, since=since, immutable=not args.no_snapshot)
+        books = measure_iter(books, 'extract')
+        if store is not None:
+            books = store_books(books, store, str(db_path), full=not since)
+    if not since:
+        books = add_emptied_books(books, synced_titles)
+    for export_format, export_path in exports:
+        books = EXPORT_FORMATS[export_format](books, export_path)
+    if reading_order:
+        books = sort_reading_order(books)
+    books = filter_changed_books(books, book_states, new_book_states)
+
+    if notion:
+        print(f"\nSending notes to Notion page: {notion['parent_id']}")
+    else:
+        print(f"\nCreating notes in: {obsidian_path / highlights_folder_name}")
     if calibre_library_path:
         print(f"Looking up books in Calibre library...")
 
-    created_files = []
-    for book in books_with_highlights:
-        # Look up book in Calibre if library path is available
-        calibre_info = None
-        if calibre_library_path:
-            calibre_info = lookup_calibre_book(calibre_library_path, book['title'], book['author'])
+    workers = args.jobs or config.get('write_workers', DEFAULT_WRITE_WORKERS)
 
-        filepath = create_obsidian_note(book, obsidian_path, calibre_info, calibre_library_path, highlights_folder_name)
-        created_files.append(filepath)
+    written_count = 0
+    unchanged_count = 0
+    removed_count = 0
+    emptied_count = 0
+    matched = 0
+    failures = []
 
-        if calibre_info:
-            print(f"  ✓ Created: {filepath.name} (with Calibre links)")
+    if notion:
+        workers = notion['concurrency']
+        try:
+            notion_client = NotionClient(notion['token'], notion['api_url'], concurrency=workers)
+        except ValueError as e:
+            print(f"\nError: Invalid notion_api_url: {e}")
+            sys.exit(EXIT_CONFIG)
+        notion_map = NotionMap()
+
+        def write(book, calibre_info):
+            return write_notion_page(notion_client, notion_map, notion['parent_id'], book)
+    else:
+        def write(book, calibre_info):
+            return create_note(book, obsidian_path, calibre_info, calibre_library_path, highlights_folder_name,
+                               merge=merge, note_format=note_format, templates=templates, shard_min=shard_min)
+
+    def report(book, calibre_info, target, written, error):
+        nonlocal written_count, unchanged_count, removed_count, emptied_count, matched
+        if calibre_info and book.highlights:
+            matched += 1
+        if not book.highlights:
+            emptied_count += 1
+
+        if error is not None:
+            failures.append((book.title, error))
+            print(f"  ✗ Failed: {book.title} ({error})")
+            return
+
+        # A note file's name, or a Notion page's book title
+        name = target.name if isinstance(target, Path) else target
+        if not book.highlights:
+            # Every highlight was deleted on the device; forget the book
+            book_states.pop(book.title, None)
+            if written:
+                removed_count += 1
+                print(f"  - Removed: {name} (no highlights left)")
+            return
+        if not written:
+            unchanged_count += 1
+            print(f"  = Unchanged: {name}")
+            return
+
+        written_count += 1
+        if calibre_info and calibre_info['score'] < 1:
+            print(f"  ✓ Created: {name} (with Calibre links, fuzzy match {calibre_info['score']:.2f})")
+        elif calibre_info:
+            print(f"  ✓ Created: {name} (with Calibre links)")
         else:
-            print(f"  ✓ Created: {filepath.name}")
+            print(f"  ✓ Created: {name}")
+
+    # Reading books.db, matching in Calibre and writing to the vault overlap,
+    # so a sync takes about as long as the slowest of them
+    import asyncio
+    try:
+        asyncio.run(run_pipeline(books, calibre_library_path, write, report, workers=workers))
+    except sqlite3.Error as e:
+        # The watermark was read before extraction, so saving it would skip
+        # the books that were never read; the store's changes roll back too
+        print(f"\nDatabase error while reading highlights: {e}")
+        print("The sync state was not saved; the next sync reads these books again.")
+        if store is not None:
+            store.close()
+        sys.exit(EXIT_ERROR)
+    finally:
+        if notion:
+            notion_client.close()
+            notion_map.close()
+
+    for export_format, export_path in exports:
+        print(f"  ✓ Exported all highlights to {export_path} ({export_format})")
+
+    if store is not None:
+        store.commit()
+        store.close()
+
+    processed_count = written_count + unchanged_count + removed_count + len(failures)
+    skipped_count = len(new_book_states) + emptied_count - processed_count
+
+    if not new_book_states and not since and not emptied_count:
+        print("\nNo highlights found in the database.")
+        print("Make sure you have highlighted text in some books on your Pocketbook.")
+        sys.exit(EXIT_OK)
+
+    # Keep the old watermark when a note failed so the book is retried
+    if failures:
+        watermark = since and {'max_oid': since['max_oid'], 'max_time': since['max_time']}
+        highlight_counts = state.get('highlight_counts')
+        fingerprint = None
+        for title, error in failures:
+            new_book_states.pop(title, None)
+
+    book_states.update(new_book_states)
+    save_state({
+        'db_path': source_id,
+        'notes_path': notes_path,
+        'render': render,
+        'watermark': watermark,
+        'highlight_counts': highlight_counts,
+        'fingerprint': fingerprint,
+        'books': book_states
+    })
+
+    if not processed_count:
+        print("\nNo new highlights since the last sync.")
+        print("Run with --full-resync to regenerate every note.")
+        sys.exit(EXIT_OK)
 
     print(f"\n{'=' * 60}")
-    print(f"Sync complete! Created {len(created_files)} file(s).")
+    removed = f", {removed_count} removed" if removed_count else ""
+    print(f"Sync complete! Wrote {written_count} {'page' if notion else 'file'}(s), "
+          f"{unchanged_count} unchanged{removed}, {skipped_count} skipped.")
     if calibre_library_path:
-        matched = sum(1 for book in books_with_highlights if lookup_calibre_book(calibre_library_path, book['title'], book['author']))
         print(f"Matched {matched} book(s) to Calibre library.")
+    if failures:
+        print(f"Failed to write {len(failures)} note(s):")
+        for title, error in failures:
+            print(f"  - {title}: {error}")
     print(f"{'=' * 60}")
 
+    if failures:
+        sys.exit(EXIT_WRITE_FAILED)
+
+
+def run_watched_sync(args, config, mount):
+    """Sync from one mounted device in batch mode and return the exit status."""
+    run_args = argparse.Namespace(**{**vars(args), 'device': str(mount), 'batch': True})
+    reset_metrics()
+    try:
+        sync(run_args, config)
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else EXIT_ERROR
+    except Exception as e:
+        print(f"\nError: {e}")
+        return EXIT_ERROR
+    return EXIT_OK
+
+
+def watch(args, config):
+    """Poll for a mounted Pocketbook and sync each time one appears or changes.
+
+    Each check lists the mounted volumes and stats books.db. The header is
+    only read when a database appears or its size or mtime changes. A
+    database whose fingerprint matches the last completed sync is not
+    synced again, so re-mounting a reader with nothing new costs a stat()
+    and a 100-byte read.
+    """
+    import signal
+
+    # Fail now rather than on the first mount if the vault or the Notion
+    # settings are missing
+    if get_notion_settings(config) is None:
+        get_obsidian_path(config, args.vault, batch=True)
+
+    # launchd and systemd stop services with SIGTERM; treat it like Ctrl-C
+    # so a sync in progress cleans up its temp files
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    print(f"Watching for a Pocketbook every {args.interval:g}s. Press Ctrl-C to stop.")
+    seen = {}
+    try:
+        while True:
+            poll_pocketbooks(args, config, seen)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+
+
+def poll_pocketbooks(args, config, seen):
+    """Sync each mounted Pocketbook that appeared or changed since the last poll.
+
+    ``seen`` maps books.db paths to their signature at the last poll and is
+    updated in place.
+    """
+    devices = find_pocketbooks([args.device, config.get('pocketbook_path')])
+
+    for db_path, mount in devices.items():
+        signature = file_signature(db_path)
+        if signature is None or seen.get(db_path) == signature:
+            continue
+        seen[db_path] = signature
+
+        state = load_state()
+        fingerprint = database_fingerprint(db_path)
+        if (fingerprint is not None and state.get('db_path') == str(db_path)
+                and state.get('fingerprint') == fingerprint):
+            print(f"Pocketbook at {mount}: no changes since the last sync.")
+            continue
+
+        print(f"\nPocketbook at {mount}: syncing...")
+        status = run_watched_sync(args, config, mount)
+        if status in (EXIT_NO_VAULT, EXIT_CONFIG):
+            # Settings that can't fix themselves stop the watch
+            sys.exit(status)
+        if status != EXIT_OK:
+            print(f"Sync exited with status {status}; it is retried the next time the device is mounted.")
+        print("\nWaiting for the next Pocketbook...")
+
+    for db_path in set(seen) - set(devices):
+        del seen[db_path]
+        print(f"Pocketbook at {db_path.parents[2]} removed.")
+
 
 if __name__ == '__main__':
     try:
         main()
     except KeyboardInterrupt:
         print("\n\nSync cancelled by user.")
-        sys.exit(0)
+        sys.exit(EXIT_CANCELLED)
     except Exception as e:
         print(f"\nError: {e}")
         import traceback
         traceback.print_exc()
-        sys.exit(1)
+        sys.exit(EXIT_ERROR)
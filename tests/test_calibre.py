@@ -0,0 +1,41 @@
+"""Tests for matching Pocketbook books to a Calibre library."""
+
+import pytest
+
+import benchmark
+import sync_highlights
+
+LIBRARY = [
+    ('It Ends with Us', 'Colleen Hoover'),
+    ('War and Peace', 'Leo Tolstoy'),
+    ('Dune Messiah', 'Frank Herbert'),
+    ('The Fire Next Time', 'James Baldwin'),
+    ('The Left Hand of Darkness', 'Ursula K. Le Guin'),
+    ('The Count of Monte Cristo', 'Alexandre Dumas'),
+]
+
+
+@pytest.fixture(scope='module')
+def index(tmp_path_factory):
+    library_path = tmp_path_factory.mktemp('calibre') / 'Calibre Library'
+    benchmark.write_calibre_db(library_path, LIBRARY)
+    return sync_highlights.build_calibre_index(library_path)
+
+
+@pytest.mark.parametrize('title, author, expected', [
+    ('The Fire Next Time', 'James Baldwin', 'The Fire Next Time'),
+    ('Fire Next Time', 'Baldwin, James', 'The Fire Next Time'),
+    ('The Left Hand of Darkness: 50th Anniversary Edition', 'Ursula K. Le Guin', 'The Left Hand of Darkness'),
+    ('Le Comte de Monte-Cristo', 'Unknown Author', None),
+    ('The Count of Monte Cristo (Illustrated Edition)', 'Alexandre Dumas', 'The Count of Monte Cristo'),
+    # A shorter title inside a longer one is a different book
+    ('It', 'Stephen King', None),
+    ('Peace', 'Jane Doe', None),
+    ('Dune', 'Frank Herbert', None),
+    # The same title by an author who shares no name with Calibre's
+    ('War and Peace', 'Jane Doe', None),
+    ('The Fire Next Time', 'Someone Else', None),
+])
+def test_match_calibre_index(index, title, author, expected):
+    info = sync_highlights.match_calibre_index(index, title, author)
+    assert (info and info['title']) == expected
@@ -0,0 +1,88 @@
+"""Tests for parsing EPUB CFIs and ordering highlights by them."""
+
+import pytest
+
+import sync_highlights
+from sync_highlights import EpubCfi, Highlight
+
+
+@pytest.mark.parametrize('cfi, expected', [
+    ('/6/4!/4/10/2:3', EpubCfi((6, 4, 4, 10, 2), 4, 3)),
+    ('epubcfi(/6/4!/4/10/2:3)', EpubCfi((6, 4, 4, 10, 2), 4, 3)),
+    ('/6/4', EpubCfi((6, 4), None, 0)),
+    # Assertions, including ones with escaped brackets, don't change the path
+    ('/6/14[chap05ref]!/4[body01]/10[para05]/3:10', EpubCfi((6, 14, 4, 10, 3), 14, 10)),
+    ('/6/4[chap^]01]!/4[id^[x^]]/2:5', EpubCfi((6, 4, 4, 2), 4, 5)),
+    ('/6/4!/4/2:7[;s=b]', EpubCfi((6, 4, 4, 2), 4, 7)),
+    # A range is reduced to its start
+    ('/6/4!/4/10,/2:5,/3:8', EpubCfi((6, 4, 4, 10, 2), 4, 5)),
+    ('epubcfi(/6/4[ch]!/4,/2/1:0,/6/1:12)', EpubCfi((6, 4, 4, 2, 1), 4, 0)),
+    # Nested indirection keeps the first spine step
+    ('/6/4!/4/2!/6/2:1', EpubCfi((6, 4, 4, 2, 6, 2), 4, 1)),
+    ('/6/4[ch]!/4/2[frame]!/6/2:1', EpubCfi((6, 4, 4, 2, 6, 2), 4, 1)),
+    # Temporal and spatial offsets don't affect ordering
+    ('/6/4!/4/2~12.5@10:20', EpubCfi((6, 4, 4, 2), 4, 0)),
+])
+def test_parse_epubcfi(cfi, expected):
+    assert sync_highlights.parse_epubcfi(cfi) == expected
+
+
+@pytest.mark.parametrize('cfi', [
+    None,
+    '',
+    'not a cfi',
+    'epubcfi()',
+    '6/4!/4/2',
+    '/6/x!/4',
+    '/6/4!4/2',
+    '/6/4[unterminated!/4/2',
+    '!/4/2',
+    '/6/4!/4/2:abc',
+])
+def test_parse_epubcfi_rejects_invalid(cfi):
+    assert sync_highlights.parse_epubcfi(cfi) is None
+
+
+@pytest.mark.parametrize('earlier, later', [
+    # A position precedes everything inside it, whatever its offset
+    ('/6/4!/4/10', '/6/4!/4/10/2'),
+    ('/6/4!/4/10:50', '/6/4!/4/10/2:0'),
+    ('/6/4!/4/10,/2:5,/3:8', '/6/4!/4/10/2:6'),
+    # Steps and offsets compare as numbers
+    ('/6/4!/4/2', '/6/4!/4/10'),
+    ('/6/4!/4/10/2:5', '/6/4!/4/10/2:12'),
+    ('/6/8!/4/2', '/6/12!/2'),
+    # Highlights without a valid CFI come last
+    ('/6/40!/4/2', None),
+    ('/6/40!/4/2', 'not a cfi'),
+])
+def test_reading_order(earlier, later):
+    first = Highlight(1, "Earlier", position=50, epubcfi=earlier)
+    second = Highlight(2, "Later", position=1, epubcfi=later)
+    assert sorted([second, first], key=sync_highlights.reading_order_key) == [first, second]
+
+
+def test_chapter_sections_in_spine_order():
+    highlights = [
+        Highlight(1, "Chapter 12, late", epubcfi='/6/12!/4/8:3'),
+        Highlight(2, "No CFI, page 9", position=9),
+        Highlight(3, "Chapter 10", epubcfi='epubcfi(/6/10[ch]!/4/2,/1:0,/1:5)'),
+        Highlight(4, "Chapter 4, inside", epubcfi='/6/4!/4/10/2:1'),
+        Highlight(5, "Invalid CFI, page 2", position=2, epubcfi='/6/x'),
+        Highlight(6, "Chapter 12, early", epubcfi='/6/12!/4/2'),
+        Highlight(7, "Chapter 4, parent", epubcfi='/6/4!/4/10:80'),
+    ]
+
+    sections = sync_highlights.chapter_sections(highlights)
+
+    assert [(spine, [highlight.id for highlight in section]) for spine, section in sections] == [
+        (4, [7, 4]),
+        (10, [3]),
+        (12, [6, 1]),
+        (None, [5, 2]),
+    ]
+
+
+def test_chapter_sections_without_cfis():
+    highlights = [Highlight(1, "Page 5", position=5), Highlight(2, "Page 1", position=1)]
+    assert sync_highlights.chapter_sections(highlights) == [(None, [highlights[1], highlights[0]])]
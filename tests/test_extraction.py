@@ -0,0 +1,65 @@
+"""Tests for extracting highlights from books.db."""
+
+import pytest
+
+import benchmark
+import sync_highlights
+
+
+def extract_traced(monkeypatch, db_path, **kwargs):
+    """Run iter_books() and return its books and the SQL statements it ran."""
+    statements = []
+    open_books_db = sync_highlights.open_books_db
+
+    def traced(*args, **open_kwargs):
+        conn = open_books_db(*args, **open_kwargs)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(sync_highlights, 'open_books_db', traced)
+    books = list(sync_highlights.iter_books(db_path, **kwargs))
+    monkeypatch.undo()
+    return books, statements
+
+
+def write_books_db(tmp_path, highlights, books):
+    catalog = benchmark.make_catalog(books)
+    db_path = tmp_path / f"books-{highlights}.db"
+    benchmark.write_books_db(db_path, catalog, highlights, books)
+    return db_path
+
+
+@pytest.mark.parametrize('use_json1', [True, False])
+def test_query_count_does_not_grow_with_highlights(monkeypatch, tmp_path, use_json1):
+    small = write_books_db(tmp_path, 50, 5)
+    large = write_books_db(tmp_path, 2000, 100)
+
+    small_books, small_statements = extract_traced(monkeypatch, small, use_json1=use_json1)
+    large_books, large_statements = extract_traced(monkeypatch, large, use_json1=use_json1)
+
+    assert sum(len(book.highlights) for book in large_books) > 10 * sum(len(book.highlights) for book in small_books)
+    assert len(small_statements) == len(large_statements)
+
+
+def test_incremental_query_count_does_not_grow_with_highlights(monkeypatch, tmp_path):
+    counts = []
+    for highlights, books in ((50, 5), (2000, 100)):
+        db_path = write_books_db(tmp_path, highlights, books)
+        watermark = sync_highlights.get_highlight_watermark(db_path)
+        since = {'max_oid': watermark['max_oid'] - 10, 'max_time': watermark['max_time'], 'parents': [1, 2]}
+        _, statements = extract_traced(monkeypatch, db_path, since=since)
+        counts.append(len(statements))
+
+    assert counts[0] == counts[1]
+
+
+def test_incremental_books_match_full_extraction(tmp_path):
+    db_path = write_books_db(tmp_path, 2000, 100)
+    watermark = sync_highlights.get_highlight_watermark(db_path)
+    since = {'max_oid': watermark['max_oid'] - 10, 'max_time': watermark['max_time'], 'parents': [1, 2]}
+
+    full = {book.title: book for book in sync_highlights.iter_books(db_path)}
+    changed = list(sync_highlights.iter_books(db_path, since=since))
+
+    assert changed
+    assert all(book == full[book.title] for book in changed)
@@ -0,0 +1,82 @@
+"""Tests for incremental syncs against a generated books.db."""
+
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import benchmark
+import sync_highlights
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture
+def device(tmp_path):
+    """A mounted Pocketbook with a generated books.db, a vault and a home folder."""
+    db_path = tmp_path / 'device' / 'system' / 'config' / 'books.db'
+    benchmark.write_books_db(db_path, benchmark.make_catalog(10), 200, 10)
+    (tmp_path / 'vault').mkdir()
+    (tmp_path / 'home').mkdir()
+    return tmp_path
+
+
+def run_sync(workdir, *args):
+    """Run a batch sync in a fresh process with ``workdir/home`` as the home folder."""
+    env = dict(os.environ, HOME=str(workdir / 'home'))
+    return subprocess.run(
+        [sys.executable, '-m', 'sync_highlights', '--batch', '--no-calibre',
+         '--device', str(workdir / 'device'), '--vault', str(workdir / 'vault'), *args],
+        cwd=REPO, env=env, capture_output=True, text=True
+    )
+
+
+def load_state(workdir):
+    with open(workdir / 'home' / '.pocketbook_sync_state.json') as f:
+        return json.load(f)
+
+
+def delete_book_highlights(db_path, title):
+    """Delete every highlight item of the books titled ``title``; return how many."""
+    conn = sqlite3.connect(db_path)
+    with conn:
+        parents = [row[0] for row in conn.execute(
+            "SELECT ItemID FROM Tags WHERE TagID = (SELECT OID FROM TagNames WHERE TagName = 'doc.book-title') "
+            "AND Val = ?", (title,)
+        )]
+        items = [row[0] for parent in parents for row in conn.execute(
+            "SELECT OID FROM Items WHERE TypeID = 4 AND ParentID = ?", (parent,)
+        )]
+        conn.executemany("DELETE FROM Tags WHERE ItemID = ?", ((item,) for item in items))
+        conn.executemany("DELETE FROM Items WHERE OID = ?", ((item,) for item in items))
+    conn.close()
+    return len(items)
+
+
+def stored_highlights(workdir, title):
+    conn = sqlite3.connect(workdir / 'home' / '.pocketbook_sync_highlights.db')
+    try:
+        return conn.execute("SELECT COUNT(*) FROM highlights WHERE book = ?", (title,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_book_without_highlights_left_loses_its_note(device):
+    assert run_sync(device).returncode == 0
+    title = sorted(load_state(device)['books'])[0]
+    note = device / 'vault' / 'Book Highlights' / sync_highlights.sanitize_filename(f"{title}.md")
+    assert note.exists()
+    assert stored_highlights(device, title)
+
+    assert delete_book_highlights(device / 'device' / 'system' / 'config' / 'books.db', title)
+    result = run_sync(device)
+
+    assert result.returncode == 0, result.stdout
+    assert not note.exists()
+    assert title not in load_state(device)['books']
+    assert "1 removed" in result.stdout
+    assert stored_highlights(device, title) == 0
@@ -0,0 +1,111 @@
+"""Tests for patching merge-mode Obsidian notes."""
+
+from datetime import datetime
+
+import pytest
+
+import sync_highlights
+from sync_highlights import Book, Highlight
+
+NOW = datetime(2024, 5, 6, 7, 8)
+
+HIGHLIGHTS = [
+    Highlight(101, "The first highlight.", position=3, timestamp=1700000000),
+    Highlight(102, "The second highlight.", annotation="A note of mine.", position=9, timestamp=1700000100),
+]
+
+USER_TOP = "My thoughts before the highlights.\n\n"
+USER_MIDDLE = "\nA comment between two highlights.\n"
+USER_BOTTOM = "\n## My Summary\n\nWritten by hand, with trailing spaces.  \n"
+
+
+class FrozenDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return NOW
+
+
+@pytest.fixture(autouse=True)
+def frozen_now(monkeypatch):
+    monkeypatch.setattr(sync_highlights, 'datetime', FrozenDatetime)
+
+
+def render(highlights):
+    return sync_highlights.render_obsidian_note(
+        Book("A Test Book", "Ann Author", highlights),
+        sync_date=NOW.strftime('%Y-%m-%d'), synced=NOW.strftime('%Y-%m-%d %H:%M'), markers=True
+    )
+
+
+def edited_note():
+    """A merge-mode note the user wrote around: above, between and below the highlights."""
+    note = render(HIGHLIGHTS)
+    first_end = f"<!-- /pocketbook-highlight:{HIGHLIGHTS[0].id} -->\n"
+    note = note.replace(first_end, first_end + USER_MIDDLE, 1)
+    first_start = f"<!-- pocketbook-highlight:{HIGHLIGHTS[0].id} "
+    note = note.replace(first_start, USER_TOP + first_start, 1)
+    return note + USER_BOTTOM
+
+
+def merge(existing, highlights):
+    return sync_highlights.merge_obsidian_note(existing, Book("A Test Book", "Ann Author", highlights))
+
+
+def outside_markers(note):
+    """Split a note into the text between its highlight blocks."""
+    return sync_highlights.HIGHLIGHT_BLOCK_PATTERN.split(note)[::3]
+
+
+def test_unchanged_highlights_return_none():
+    assert merge(edited_note(), HIGHLIGHTS) is None
+
+
+def test_note_without_markers_returns_none():
+    plain = sync_highlights.render_obsidian_note(Book("A Test Book", "Ann Author", HIGHLIGHTS))
+    assert merge(plain, HIGHLIGHTS) is None
+
+
+def test_new_highlight_goes_after_last_block_and_before_user_text():
+    existing = edited_note()
+    new = Highlight(103, "A highlight made since the last sync.", position=12, timestamp=1700000200)
+
+    merged = merge(existing, HIGHLIGHTS + [new])
+
+    last_end = f"<!-- /pocketbook-highlight:{HIGHLIGHTS[-1].id} -->"
+    new_start = merged.index(f"<!-- pocketbook-highlight:{new.id} ")
+    assert merged.index(last_end) < new_start < merged.index(USER_BOTTOM)
+    assert merged.endswith(USER_BOTTOM)
+    assert new.text in merged
+
+
+def test_changed_highlight_is_patched_in_place():
+    existing = edited_note()
+    changed = HIGHLIGHTS[0]._replace(annotation="Added on the device later.")
+
+    merged = merge(existing, [changed, HIGHLIGHTS[1]])
+
+    first_block, second_block = sync_highlights.HIGHLIGHT_BLOCK_PATTERN.finditer(merged)
+    assert first_block.group(1) == str(changed.id)
+    assert changed.annotation in first_block.group(0)
+    assert second_block.group(1) == str(HIGHLIGHTS[1].id)
+    assert merged.count("<!-- pocketbook-highlight:101 ") == 1
+    assert merged.index(USER_TOP) < first_block.start() < merged.index(USER_MIDDLE) < second_block.start()
+
+
+@pytest.mark.parametrize('highlights', [
+    [HIGHLIGHTS[0]._replace(text="The first highlight, corrected."), HIGHLIGHTS[1]],
+    HIGHLIGHTS + [Highlight(103, "A new one.", position=12, timestamp=1700000200)],
+    # A highlight deleted on the device keeps its block
+    HIGHLIGHTS[1:] + [Highlight(103, "A new one.", position=12, timestamp=1700000200)],
+])
+def test_text_outside_markers_is_kept_byte_for_byte(highlights):
+    existing = edited_note()
+
+    merged = merge(existing, highlights)
+
+    before = outside_markers(existing)
+    after = outside_markers(merged)
+    # New blocks are appended with their own separator after the last block
+    assert after[:len(before) - 1] == before[:-1]
+    assert after[-1] == before[-1]
+    assert USER_TOP in before[0] and USER_MIDDLE in before[1] and USER_BOTTOM in before[-1]
@@ -0,0 +1,169 @@
+"""Tests for the Notion sink against a local stand-in for the Notion API."""
+
+import json
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import sync_highlights
+from sync_highlights import Book, Highlight, NotionClient, NotionMap, write_notion_page
+
+PARENT_ID = '11111111-2222-3333-4444-555555555555'
+
+
+class StandInNotion(ThreadingHTTPServer):
+    """Keeps pages and blocks in memory and answers the endpoints the sink uses.
+
+    ``drop`` maps ``(method, kind)`` to a number of requests to apply and
+    then hang up on without a response, as a dropped connection would.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.children = {PARENT_ID: []}
+        self.blocks = {}
+        self.requests = []
+        self.drop = {}
+
+    @property
+    def api_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def add_block(self, parent_id, block):
+        block = dict(block, id=str(uuid.uuid4()))
+        self.blocks[block['id']] = block
+        self.children[parent_id].append(block['id'])
+        return block
+
+    def pages(self, title):
+        return [block_id for block_id in self.children[PARENT_ID]
+                if self.blocks[block_id]['child_page']['title'] == title]
+
+    def quotes(self, page_id):
+        return [sync_highlights.notion_block_text(self.blocks[block_id]).split('\n')[0]
+                for block_id in self.children[page_id] if self.blocks[block_id]['type'] == 'quote']
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        path = self.path[len('/v1'):].split('?')[0]
+        parts = path.strip('/').split('/')
+        kind = 'pages' if parts[0] == 'pages' else parts[-1]
+        server = self.server
+
+        with server.lock:
+            server.requests.append((method, path))
+            if method == 'POST' and path == '/pages':
+                title = ''.join(item['text']['content'] for item in body['properties']['title']['title'])
+                page = server.add_block(PARENT_ID, {'type': 'child_page', 'child_page': {'title': title}})
+                server.children[page['id']] = []
+                for child in body.get('children', []):
+                    server.add_block(page['id'], child)
+                response = {'object': 'page', 'id': page['id']}
+            elif parts[-1] == 'children' and parts[1] in server.children:
+                if method == 'GET':
+                    response = {'object': 'list', 'has_more': False, 'next_cursor': None,
+                                'results': [server.blocks[block_id] for block_id in server.children[parts[1]]]}
+                else:
+                    response = {'object': 'list',
+                                'results': [server.add_block(parts[1], child) for child in body['children']]}
+            elif method == 'PATCH' and parts[1] in server.blocks:
+                server.blocks[parts[1]].update(body)
+                response = server.blocks[parts[1]]
+            else:
+                return self.reply(404, {'object': 'error', 'status': 404, 'code': 'object_not_found',
+                                        'message': 'not found'})
+
+            if server.drop.get((method, kind)):
+                server.drop[(method, kind)] -= 1
+                self.close_connection = True
+                return
+        self.reply(200, response)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+
+@pytest.fixture
+def notion():
+    server = StandInNotion()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(notion):
+    client = NotionClient('secret', api_url=notion.api_url, rate=1000, burst=1000, backoff=0.01)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def notion_map(tmp_path):
+    notion_map = NotionMap(tmp_path / 'notion.db')
+    yield notion_map
+    notion_map.close()
+
+
+def make_book(count):
+    highlights = [Highlight(i, f"Highlight {i}", None, i, None, 1600000000 + i, 'highlight') for i in range(count)]
+    return Book('A Book', 'An Author', highlights)
+
+
+def test_dropped_append_is_not_sent_twice(notion, client, notion_map):
+    write_notion_page(client, notion_map, PARENT_ID, make_book(2))
+    notion.drop[('PATCH', 'children')] = 1
+
+    write_notion_page(client, notion_map, PARENT_ID, make_book(10))
+
+    page_id = notion_map.page(PARENT_ID, 'A Book')
+    assert notion.quotes(page_id) == [f"Highlight {i}" for i in range(10)]
+    assert sorted(block_id for block_id, _ in notion_map.blocks(page_id).values()) == \
+        sorted(notion.children[page_id][2:])
+
+
+def test_dropped_page_creation_is_not_sent_twice(notion, client, notion_map):
+    notion.drop[('POST', 'pages')] = 1
+
+    write_notion_page(client, notion_map, PARENT_ID, make_book(3))
+
+    assert notion.pages('A Book') == [notion_map.page(PARENT_ID, 'A Book')]
+    assert notion.quotes(notion_map.page(PARENT_ID, 'A Book')) == ['Highlight 0', 'Highlight 1', 'Highlight 2']
+    assert notion.requests.count(('POST', '/pages')) == 1
+
+
+def test_rerun_sends_only_changes(notion, client, notion_map):
+    write_notion_page(client, notion_map, PARENT_ID, make_book(3))
+    sent = len(notion.requests)
+
+    assert write_notion_page(client, notion_map, PARENT_ID, make_book(3)) == ('A Book', False)
+    assert len(notion.requests) == sent